@@ -1,17 +1,20 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, jsonify, send_file, g
 from flask_cors import CORS
 from segment_anything import sam_model_registry, SamPredictor, SamAutomaticMaskGenerator
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 from arg_parse import parser
-from utils import mkdir_or_exist
-from collections import deque
+from utils import mkdir_or_exist, hash_image, union_bbox, intersect_bbox, PackedMask
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError, Future
 import threading
 import queue
+import uuid
 import cv2
 import numpy as np
 import io, os
 import time
 import base64
+import json
 import argparse
 import torch
 import torchvision
@@ -34,9 +37,13 @@ class Mode:
 
 MODE = Mode()
 
+SESSION_COOKIE = "sam_session"
+SESSION_HEADER = "X-Session-Token"
+
 class SamAutoMaskGen:
     def __init__(self, model, args) -> None:
-        output_mode = "coco_rle" if args.convert_to_rle else "binary_mask"
+        # Masks are packed to their boxes right away, so skip building full-size ones
+        output_mode = "coco_rle" if args.convert_to_rle else "cropped_binary_mask"
         self.amg_kwargs = self.get_amg_kwargs(args)
         self.generator = SamAutomaticMaskGenerator(model, output_mode=output_mode, **self.amg_kwargs)
 
@@ -53,59 +60,619 @@ class SamAutoMaskGen:
             "crop_overlap_ratio": args.crop_overlap_ratio,
             "crop_n_points_downscale_factor": args.crop_n_points_downscale_factor,
             "min_mask_region_area": args.min_mask_region_area,
+            "filter_at_low_res": args.filter_at_low_res,
+            "crops_per_batch": args.crops_per_batch,
+            "adaptive_sampling_levels": args.adaptive_sampling_levels,
+            "crop_min_edge_density": args.crop_min_edge_density,
+            "crop_max_coverage": args.crop_max_coverage,
         }
         amg_kwargs = {k: v for k, v in amg_kwargs.items() if v is not None}
         return amg_kwargs
 
-    def generate(self, image) -> np.ndarray:
-        masks = self.generator.generate(image)
-        np_masks = []
+    def generate_stream(self, image, preview=True, features=None):
+        """ Generate masks for the whole image, yielding an update after every point batch
+
+        features is the image embedding of the whole image if it was already
+        computed, so that the image encoder only runs on the smaller crops.
+        Updates are the generator's, with the records packed to their bounding
+        boxes into "masks".
+        Masks of intermediate updates may overlap each other, the final update
+        holds the deduplicated masks that replace all of them.
+        """
+        for update in self.generator.generate_stream(image, preview=preview, image_embedding=features):
+            update["masks"] = self.pack(update.pop("records"))
+            yield update
+
+    def pack(self, masks) -> List[PackedMask]:
+        """ Pack mask records of the generator, each to its bounding box """
+        packed_masks = []
         for i, mask_data in enumerate(masks):
             mask = mask_data["segmentation"]
-            np_masks.append(mask)
+            x, y, w, h = (int(v) for v in mask_data["bbox"])
+            bbox = (y, y + h + 1, x, x + w + 1)
+            if self.generator.output_mode == "cropped_binary_mask":
+                packed_masks.append(PackedMask(mask, bbox))
+                continue
+            if isinstance(mask, dict):
+                from pycocotools import mask as mask_utils  # type: ignore
+                mask = mask_utils.decode(mask).astype(bool)
+            packed_masks.append(PackedMask.from_mask(mask, bbox))
+            mask_data["segmentation"] = None    # Drop the full-size mask right away
+
+        return packed_masks
+
+class MaskCompositor:
+    """ Label-map based mask layers of one image
+
+    Every positive mask gets an integer id that is painted into a label
+    image, negative masks clear the ids they cover. The overlay image, the
+    cut-out image and the colour-mask image are rendered from the label
+    image with one colour lookup-table pass, so rendering costs the same no
+    matter how many masks there are. Pushing or popping a mask only
+    re-renders its bounding box. An undo redraws the masks left underneath
+    from their packed crops, within the box of the removed masks only, so no
+    copies of the label image are kept.
+
+    parameters:
+    image:  Origin image in HWC uint8 format
+    alpha:  Transparent ratio of the mask colours from 0.0-1.0
+    """
+    VIEWS = ("processed_img", "masked_img", "colorMasks")
+
+    def __init__(
+        self,
+        image: np.ndarray,
+        alpha: float = 0.5,
+    ) -> None:
+        self.origin_image = image
+        self.alpha = alpha
+
+        self.masks = []                 # {"mask": PackedMask, "opt", "label"} in drawing order
+        self.dirty = None               # Box changed since the last take_dirty(), (y0, y1, x0, x1)
+        self.lut = np.zeros((1, 3), dtype=np.uint8)     # Tint of each label, label 0 is no mask
+        self._rng = np.random.RandomState(0)
+        self._views = {name: None for name in self.VIEWS}
+        self._stale = {name: None for name in self.VIEWS}
+        self.reset()
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    def reset(self) -> None:
+        h, w = self.origin_image.shape[:2]
+        self.masks = []
+        self.labels = np.zeros((h, w), dtype=np.int32)
+        self._invalidate((0, h, 0, w))
+
+    @property
+    def processed_img(self) -> np.ndarray:
+        return self._render("processed_img")
+
+    @property
+    def masked_img(self) -> np.ndarray:
+        return self._render("masked_img")
+
+    @property
+    def colorMasks(self) -> np.ndarray:
+        return self._render("colorMasks")
+
+    @property
+    def union(self) -> np.ndarray:
+        return self.labels > 0
+
+    def mask_color(self, label: int) -> np.ndarray:
+        """ BGR tint of a label, growing the lookup table with seeded random colours as needed """
+        if label >= len(self.lut):
+            n_new = max(label + 1, 2 * len(self.lut)) - len(self.lut)
+            colors = self._rng.random_sample((n_new, 3)) * 255 * self.alpha
+            self.lut = np.concatenate([self.lut, colors.astype(np.uint8)], axis=0)
+        return self.lut[label]
+
+    def push(self, mask, opt: str = "positive") -> None:
+        """ Draw a mask on top of the others
+
+        parameters:
+        mask:   Boolean HxW mask or PackedMask. For opt="negative" a full-size
+                mask is the region to keep and everything outside of it is
+                cleared, while a PackedMask is the region to clear.
+        opt:    "positive" or "negative"
+        """
+        if not isinstance(mask, PackedMask):
+            mask = PackedMask.from_mask(~mask if opt == "negative" else mask)
+        if opt == "negative":
+            label = 0
+        else:
+            label = sum(1 for m in self.masks if m["opt"] != "negative") + 1
+            self.mask_color(label)
+        record = {"mask": mask, "opt": opt, "label": label}
+        self.masks.append(record)
+        self._apply(record)
+        self._invalidate(mask.bbox)
+
+    def pop(self, n: int = 1) -> None:
+        """ Remove the last n masks and redraw the ones left underneath them """
+        n = min(n, len(self.masks))
+        if n <= 0:
+            return
+        target = len(self.masks) - n
+        changed = None
+        for record in self.masks[target:]:
+            changed = union_bbox(changed, record["mask"].bbox)
+        self.masks = self.masks[:target]
+        if changed is None:
+            return
+
+        y0, y1, x0, x1 = changed
+        self.labels[y0:y1, x0:x1] = 0
+        for record in self.masks:
+            self._apply(record, changed)
+        self._invalidate(changed)
+
+    def take_dirty(self):
+        """ Return the box changed since the last call and start tracking anew """
+        dirty, self.dirty = self.dirty, None
+        return dirty
+
+    def nbytes(self) -> int:
+        total = self.labels.nbytes + self.lut.nbytes
+        total += sum(view.nbytes for view in self._views.values() if view is not None)
+        total += sum(m["mask"].nbytes for m in self.masks)
+        return total
+
+    def _apply(self, record, region=None) -> None:
+        """ Paint a mask into the label image, only within region if given """
+        mask = record["mask"]
+        bbox = mask.bbox if region is None else intersect_bbox(mask.bbox, region)
+        if bbox is None:
+            return
+        y0, y1, x0, x1 = bbox
+        self.labels[y0:y1, x0:x1][mask.crop(region)] = record["label"]
+
+    def _invalidate(self, bbox) -> None:
+        self.dirty = union_bbox(self.dirty, bbox)
+        for name in self.VIEWS:
+            self._stale[name] = union_bbox(self._stale[name], bbox)
+
+    def _render(self, name: str) -> np.ndarray:
+        """ Bring one view up to date by re-rendering its stale box from the label image """
+        if self._views[name] is None:
+            self._views[name] = np.empty_like(self.origin_image)
+            h, w = self.origin_image.shape[:2]
+            self._stale[name] = (0, h, 0, w)
+        view, bbox = self._views[name], self._stale[name]
+        if bbox is None:
+            return view
+
+        y0, y1, x0, x1 = bbox
+        box = (slice(y0, y1), slice(x0, x1))
+        labels = self.labels[box]
+        if name == "colorMasks":
+            view[box] = self.lut[labels]
+        elif name == "processed_img":
+            view[box] = cv2.add(self.origin_image[box], self.lut[labels])
+        else:   # name == "masked_img"
+            view[box] = self.origin_image[box] * (labels > 0)[:, :, np.newaxis]
+        self._stale[name] = None
+        return view
+
+class Workspace:
+    """ Annotation state of one browser session
+
+    Holds the session's image, prompts, masks, undo history and the handle
+    to its image embedding, so that several annotators can share one server
+    without clobbering each other. All access goes through self.lock.
+    """
+    def __init__(self, save_path: str) -> None:
+        self.lock = threading.RLock()
+        self.save_path = save_path
+
+        self.origin_image = None
+        self.layers = None              # MaskCompositor holding the masks and the images to show
+        self.imgSize = None
+        self.image_key = None           # Content hash of origin_image, key into the embedding cache
+        self.embedding = None           # Image embedding of origin_image
+        self.embedding_future = None    # Background encoder job producing self.embedding
+        self.jobs: "OrderedDict[str, AmgJob]" = OrderedDict()   # Background auto-segmentation jobs
+        self.size = 0                   # Bytes held as of the last measure(), read without the lock
+
+        self.mode = "p_point"           # p_point / n_point / box
+        self.curr_view = "image"
+        self.sent_view = None           # View the browser currently shows, to send only changed regions
+        self.frame_id = 0               # Number of the last frame sent to the browser
+        self.queue = deque(maxlen=1000)  # For undo list
+        self.prev_inputs = deque(maxlen=500)
+
+        self.points = []
+        self.points_label = []
+        self.boxes = []
 
-        return np.array(np_masks, dtype=bool)
+    @property
+    def masks(self):
+        return self.layers.masks if self.layers is not None else []
+
+    @property
+    def processed_img(self):
+        return self.layers.processed_img if self.layers is not None else None
+
+    @property
+    def masked_img(self):
+        return self.layers.masked_img if self.layers is not None else None
+
+    @property
+    def colorMasks(self):
+        return self.layers.colorMasks if self.layers is not None else None
+
+    def set_image(self, image: np.ndarray, image_key: Optional[str] = None) -> None:
+        self.origin_image = image
+        self.image_key = image_key
+        self.layers = MaskCompositor(image)
+        self.imgSize = image.shape
+        self.embedding = None
+        self.cancel_embedding()
+        self.cancel_jobs()
+        self.reset_inputs()
+        self.queue.clear()
+        self.prev_inputs.clear()
+        # The browser shows the uploaded image itself as frame 0
+        self.layers.take_dirty()
+        self.sent_view = "image"
+        self.frame_id = 0
+
+    def cancel_embedding(self):
+        """ Cancel or discard the pending encoder job of the previous image """
+        if self.embedding_future is not None:
+            self.embedding_future.cancel()
+            self.embedding_future = None
+
+    def cancel_jobs(self):
+        """ Cancel and forget the auto-segmentation jobs of the previous image """
+        for job in self.jobs.values():
+            job.cancel()
+        self.jobs.clear()
+
+    def reset_inputs(self):
+        self.points = []
+        self.points_label = []
+        self.boxes = []
+
+    def reset_masks(self):
+        self.layers.reset()
+
+    def nbytes(self) -> int:
+        """ Approximate memory held by this workspace, in bytes """
+        total = 0
+        if self.origin_image is not None:
+            total += self.origin_image.nbytes + self.layers.nbytes()
+        if self.embedding is not None:
+            features = self.embedding["features"]
+            total += features.element_size() * features.nelement()
+        total += sum(job.nbytes() for job in self.jobs.values())
+        return total
+
+    def measure(self) -> None:
+        """ Update self.size, unless another request holds the lock and measures later """
+        if self.lock.acquire(blocking=False):
+            try:
+                self.size = self.nbytes()
+            finally:
+                self.lock.release()
+
+class WorkspaceStore:
+    """ Session-keyed workspaces with LRU eviction
+
+    parameters:
+    max_sessions:   Maximum number of workspaces kept alive
+    max_bytes:      Memory ceiling for all workspaces together, in bytes
+    save_path:      Default save path of new workspaces
+    """
+    def __init__(self, max_sessions: int, max_bytes: int, save_path: str) -> None:
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.save_path = save_path
+        self._workspaces: "OrderedDict[str, Workspace]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._workspaces)
+
+    def get(self, session_id: str, create: bool = False) -> Workspace:
+        """ The workspace of a session
+
+        Sessions without one get a blank workspace, kept only if create is
+        set. So requests that never upload an image, like health checks or
+        clients without a cookie jar, take no session slot.
+        """
+        with self._lock:
+            ws = self._workspaces.get(session_id)
+            if ws is None:
+                ws = Workspace(self.save_path)
+                if not create:
+                    return ws
+                self._workspaces[session_id] = ws
+            self._workspaces.move_to_end(session_id)
+        return ws
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(ws.size for ws in self._workspaces.values())
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """ Drop least recently used workspaces until both limits are met
+
+        Uses the size each workspace measured after its last request, as
+        taking the lock of every workspace could wait on a running request.
+        Workspaces busy with a request are skipped, their jobs are cancelled
+        under their own lock.
+        """
+        with self._lock:
+            sizes = {sid: ws.size for sid, ws in self._workspaces.items()}
+            total = sum(sizes.values())
+            for sid in list(self._workspaces.keys()):
+                if len(self._workspaces) <= self.max_sessions and total <= self.max_bytes:
+                    break
+                evicted = self._workspaces[sid]
+                if sid == keep or not evicted.lock.acquire(blocking=False):
+                    continue
+                try:
+                    del self._workspaces[sid]
+                    evicted.cancel_embedding()
+                    evicted.cancel_jobs()
+                finally:
+                    evicted.lock.release()
+                total -= sizes[sid]
+                print(f"Evicted session {sid[:8]} ({sizes[sid] / 2**20:.1f} MB)")
+
+class EmbeddingCache:
+    """ Content-addressed image embeddings with LRU eviction
+
+    Keys are hashes of the decoded pixels plus the model type, values hold
+    what SamPredictor.set_features needs. Bounded by max_bytes of features.
+    """
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def entry_bytes(entry: Dict[str, Any]) -> int:
+        features = entry["features"]
+        return features.element_size() * features.nelement()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        size = self.entry_bytes(entry)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self.entry_bytes(self._entries.pop(key))
+            if size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= self.entry_bytes(evicted)
+
+class InferenceWorker:
+    """ Single thread owning the model
+
+    Request handlers submit model calls to a bounded queue and wait on the
+    returned future, so SamPredictor state is never touched by two threads
+    and the work in flight is limited. Calls submitted with submit_batched
+    that arrive within batch_window seconds of each other and share a batch
+    key are run together as one batched call.
+
+    parameters:
+    max_queue:      Maximum number of pending calls, submit raises queue.Full beyond it
+    batch_window:   Seconds to wait for more batchable calls after the first one
+    max_batch:      Maximum number of calls run in one batch
+    """
+    def __init__(self, max_queue: int = 64, batch_window: float = 0.002, max_batch: int = 16) -> None:
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._backlog = deque()         # Jobs taken off the queue while collecting a batch
+        self.thread = threading.Thread(target=self._run, name="sam-inference", daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        self.jobs.put_nowait((future, fn, args, kwargs, None))
+        return future
+
+    def submit_batched(self, fn, item, batch_key) -> Future:
+        """ Submit fn(items) -> results, called with a list of items sharing batch_key """
+        future = Future()
+        self.jobs.put_nowait((future, fn, (item,), {}, batch_key))
+        return future
+
+    def _next_job(self, timeout=None):
+        if self._backlog:
+            return self._backlog.popleft()
+        return self.jobs.get(timeout=timeout)
+
+    def _collect_batch(self, job) -> List[Any]:
+        _, fn, _, _, batch_key = job
+        batch, skipped = [job], deque()
+        while self._backlog and len(batch) < self.max_batch:
+            other = self._backlog.popleft()
+            (batch if other[1] == fn and other[4] == batch_key else skipped).append(other)
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            try:
+                other = self.jobs.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            (batch if other[1] == fn and other[4] == batch_key else skipped).append(other)
+        self._backlog.extendleft(reversed(skipped))
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            job = self._next_job()
+            if job[4] is None:
+                future, fn, args, kwargs, _ = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+                continue
+
+            batch = [j for j in self._collect_batch(job) if j[0].set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+            fn = batch[0][1]
+            try:
+                results = fn([j[2][0] for j in batch])
+                for j, result in zip(batch, results):
+                    j[0].set_result(result)
+            except BaseException as e:
+                for j in batch:
+                    j[0].set_exception(e)
+
+class AmgJob:
+    """ Automatic mask generation of one image running in the background
+
+    A driver thread steps the generator on the inference worker one point
+    batch at a time, so interactive requests of every session are served in
+    between and a cancel takes effect before the next batch. The state goes
+    from "queued" to "running" and ends as "done", "cancelled" or "failed".
+
+    parameters:
+    generator:  SamAutoMaskGen to run
+    worker:     InferenceWorker to run the steps on
+    image:      Image to segment
+    embedding:  Image embedding of image, or the Future of the encoder job computing it
+    """
+    FINISHED = ("done", "cancelled", "failed")
+
+    def __init__(self, generator, worker, image: np.ndarray, embedding=None) -> None:
+        self.id = uuid.uuid4().hex
+        self.state = "queued"
+        self.progress = {"crops_done": 0, "num_crops": 0, "batches_done": 0, "num_batches": 0}
+        self.masks: Optional[List[PackedMask]] = None
+        self.error = None
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(generator, worker, image, embedding), name=f"amg-job-{self.id[:8]}", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def finished(self) -> bool:
+        return self.state in self.FINISHED
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def status(self) -> Dict[str, Any]:
+        status = {"job_id": self.id, "state": self.state, "progress": dict(self.progress)}
+        if self.masks is not None:
+            status["num_masks"] = len(self.masks)
+        if self.error is not None:
+            status["error"] = self.error
+        return status
+
+    def nbytes(self) -> int:
+        return sum(mask.nbytes for mask in self.masks) if self.masks is not None else 0
+
+    def wait(self) -> List[PackedMask]:
+        """ Block until the job finished and return its masks """
+        self._thread.join()
+        if self.state != "done":
+            raise RuntimeError(f"Auto-segmentation {self.state}: {self.error}")
+        return self.masks
+
+    def _run(self, generator, worker, image, embedding) -> None:
+        try:
+            if isinstance(embedding, Future):
+                embedding = embedding.result()
+            features = embedding["features"] if embedding is not None else None
+        except Exception:
+            features = None     # The encoder job was cancelled, encode along with the crops
+        stream = generator.generate_stream(image, preview=False, features=features)
+        try:
+            while not self._cancel.is_set():
+                try:
+                    update = worker.submit(next, stream).result()
+                except queue.Full:
+                    time.sleep(0.05)    # Interactive requests fill the queue, let them through first
+                    continue
+                self.state = "running"
+                self.progress = {k: update[k] for k in self.progress}
+                if update["final"]:
+                    self.masks = update["masks"]
+                    self.state = "done"
+                    print(f"Auto-segmentation job {self.id[:8]} done, {len(self.masks)} masks")
+                    return
+            self.state = "cancelled"
+        except Exception as e:
+            self.error = str(e)
+            self.state = "failed"
+        finally:
+            stream.close()
 
 class SAM_Web_App:
     def __init__(self, args):
         self.app = Flask(__name__)
         CORS(self.app)
-        
+
         self.args = args
 
         # load model
         print("Loading model...", end="")
         device = args.device
         print(f"using {device}...", end="")
-        sam = sam_model_registry[args.model_type](checkpoint=args.checkpoint)
+        if args.quantize:
+            # The quantized linear kernels only run on the CPU
+            if torch.device(device).type != "cpu":
+                raise ValueError("--quantize requires --device cpu")
+            print("with int8 linear layers...", end="")
+        sam = sam_model_registry[args.model_type](checkpoint=args.checkpoint, quantize=args.quantize)
         sam.to(device=device)
 
+        # The predictors are shared by all sessions and only used from the inference worker
         self.predictor = SamPredictor(sam)
         self.autoPredictor = SamAutoMaskGen(sam, args)
+        self.worker = InferenceWorker(
+            max_queue=args.inference_queue_size,
+            batch_window=args.decoder_batch_window / 1000,
+            max_batch=args.decoder_max_batch,
+        )
         print("Done")
 
-        # Store the image globally on the server
-        self.origin_image = None
-        self.processed_img = None
-        self.masked_img = None
-        self.colorMasks = None
-        self.imgSize = None
-        self.imgIsSet = False           # To run self.predictor.set_image() or not
-
-        self.mode = "p_point"           # p_point / n_point / box
-        self.curr_view = "image"
-        self.queue = deque(maxlen=1000)  # For undo list
-        self.prev_inputs = deque(maxlen=500)
-
-        self.points = []
-        self.points_label = []
-        self.boxes = []
-        self.masks = []
+        # Embeddings of recently seen images, shared by all sessions
+        self.embeddings = EmbeddingCache(max_bytes=int(args.embedding_cache_size * 2**20))
 
         # Set the default save path to the Downloads folder
         home_dir = os.path.expanduser("~")
         self.save_path = os.path.join(home_dir, "Downloads")
 
+        # One workspace per browser session
+        self.workspaces = WorkspaceStore(
+            max_sessions=args.max_sessions,
+            max_bytes=int(args.session_memory_limit * 2**20),
+            save_path=self.save_path,
+        )
+
+        self.app.before_request(self.load_session)
+        self.app.after_request(self.save_session)
+        self.app.register_error_handler(queue.Full, self.server_busy)
+
         self.app.route('/', methods=['GET'])(self.home)
         self.app.route('/upload_image', methods=['POST'])(self.upload_image)
         self.app.route('/button_click', methods=['POST'])(self.button_click)
@@ -114,50 +681,80 @@ class SAM_Web_App:
         self.app.route('/set_save_path', methods=['POST'])(self.set_save_path)
         self.app.route('/save_image', methods=['POST'])(self.save_image)
         self.app.route('/send_stroke_data', methods=['POST'])(self.handle_stroke_data)
+        self.app.route('/auto_stream', methods=['GET'])(self.auto_stream)
+        self.app.route('/amg_jobs', methods=['POST'])(self.submit_amg_job)
+        self.app.route('/amg_jobs/<job_id>', methods=['GET'])(self.amg_job_status)
+        self.app.route('/amg_jobs/<job_id>/cancel', methods=['POST'])(self.cancel_amg_job)
+        self.app.route('/amg_jobs/<job_id>/result', methods=['POST'])(self.amg_job_result)
+
+    def load_session(self):
+        session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+        g.new_session = session_id is None
+        if session_id is None:
+            session_id = uuid.uuid4().hex
+        g.session_id = session_id
+        g.workspace = self.workspaces.get(session_id)
+
+    def save_session(self, response):
+        if getattr(g, "new_session", False):
+            response.set_cookie(SESSION_COOKIE, g.session_id, httponly=True, samesite="Lax")
+        if "session_id" in g:
+            g.workspace.measure()
+            self.workspaces.evict(keep=g.session_id)
+        return response
+
+    def server_busy(self, e):
+        return jsonify({'error': 'Server busy, too many inference requests queued'}), 503
 
     def home(self):
-        return render_template('index.html', default_save_path=self.save_path)
-    
+        # No lock, it would wait for a running auto-segmentation of this session
+        return render_template('index.html', default_save_path=g.workspace.save_path)
+
     def set_save_path(self):
-        self.save_path = request.form.get("save_path")
+        ws = g.workspace = self.workspaces.get(g.session_id, create=True)
+        save_path = request.form.get("save_path")
 
         # Perform your server-side checks on the save_path here
         # e.g., check if the path exists, if it is writable, etc.
-        if os.path.isdir(self.save_path):
-            print(f"Set save path to: {self.save_path}")
+        if os.path.isdir(save_path):
+            with ws.lock:
+                ws.save_path = save_path
+            print(f"Set save path to: {save_path}")
             return jsonify({"status": "success", "message": "Save path set successfully"})
         else:
             return jsonify({"status": "error", "message": "Invalid save path"}), 400
-        
+
     def save_image(self):
+        ws = g.workspace
         # Save the colorMasks
         saveType = request.form.get("saveType")
         filename = request.form.get("filename")
         if filename == "":
             return jsonify({"status": "error", "message": "No image to save"}), 400
-        
-        # Select the appropriate image based on the saveType
-        if saveType == "colorMasks":
-            img_to_save = self.colorMasks
-        elif saveType == "masked_img":
-            img_to_save = self.masked_img
-        elif saveType == "processed_img":
-            img_to_save = self.processed_img
-        else:
-            return jsonify({"status": "error", "message": "Invalid save type"}), 400
-        
-        # Add alpha channel to cutout image (masked image) to save with transparent image
-        if saveType == "masked_img":
-            total_mask = cv2.cvtColor(self.colorMasks, cv2.COLOR_BGR2GRAY)
-            total_mask = total_mask > 0    # Region to preserve
-            alpha_channel = np.zeros(img_to_save.shape[:2], dtype=np.uint8)
-            # Update the alpha channel where the condition is True
-            alpha_channel[total_mask] = 255
-            # Stack the data in the three image channels with the alpha channel
-            img_to_save = cv2.merge((img_to_save, alpha_channel))
-        
+
+        with ws.lock:
+            # Select the appropriate image based on the saveType
+            if saveType == "colorMasks":
+                img_to_save = ws.colorMasks
+            elif saveType == "masked_img":
+                img_to_save = ws.masked_img
+            elif saveType == "processed_img":
+                img_to_save = ws.processed_img
+            else:
+                return jsonify({"status": "error", "message": "Invalid save type"}), 400
+
+            # Add alpha channel to cutout image (masked image) to save with transparent image
+            if saveType == "masked_img":
+                total_mask = ws.layers.union    # Region to preserve
+                alpha_channel = np.zeros(img_to_save.shape[:2], dtype=np.uint8)
+                # Update the alpha channel where the condition is True
+                alpha_channel[total_mask] = 255
+                # Stack the data in the three image channels with the alpha channel
+                img_to_save = cv2.merge((img_to_save, alpha_channel))
+            save_dir = ws.save_path
+
         print(f"Saving {saveType} type image: {filename} ...", end="")
-        dirname = os.path.join(self.save_path, filename)
+        dirname = os.path.join(save_dir, filename)
         mkdir_or_exist(dirname)
         # Get the number of existing files in the save_folder
         num_files = len([f for f in os.listdir(dirname) if os.path.isfile(os.path.join(dirname, f))])
@@ -174,34 +771,33 @@ class SAM_Web_App:
             return jsonify({"status": "error", "message": "Imencode error"}), 400
 
     def upload_image(self):
+        ws = g.workspace = self.workspaces.get(g.session_id, create=True)
         if 'image' not in request.files:
             return jsonify({'error': 'No image in the request'}), 400
 
         file = request.files['image']
         image = cv2.imdecode(np.frombuffer(file.read(), np.uint8), cv2.IMREAD_COLOR)
 
-        # Store the image globally
-        self.origin_image = image
-        self.processed_img = image
-        self.masked_img = np.zeros_like(image)
-        self.colorMasks = np.zeros_like(image)
-        self.imgSize = image.shape
-
-        # Create image imbedding
-        # self.predictor.set_image(image, image_format="RGB")   # Move to first inference
-
-        # Reset inputs and masks and image ebedding
-        self.imgIsSet = False
-        self.reset_inputs()
-        self.reset_masks()
-        self.queue.clear()
-        self.prev_inputs.clear()
+        # Store the image in this session's workspace and reset inputs, masks
+        # and image embedding. The embedding is taken from the cache if the same
+        # pixels were seen before, otherwise the encoder starts on it right away
+        # and the first inference waits for it.
+        image_key = hash_image(image, self.args.model_type)
+        with ws.lock:
+            ws.set_image(image, image_key)
+            ws.embedding = self.embeddings.get(image_key)
+            if ws.embedding is None:
+                try:
+                    ws.embedding_future = self.worker.submit(self.compute_embedding, image, image_key)
+                except queue.Full:
+                    print("Inference queue full, image embedding deferred to first inference")
         torch.cuda.empty_cache()
 
         return "Uploaded image, successfully initialized"
 
     def button_click(self):
-        if self.processed_img is None:
+        ws = g.workspace
+        if ws.origin_image is None:
             return jsonify({'error': 'No image available for processing'}), 400
 
         data = request.get_json()
@@ -215,146 +811,127 @@ class SAM_Web_App:
         }
 
         # Process and return the image
-        return self.process_image(self.processed_img, info)
+        with ws.lock:
+            return self.process_image(ws, info, data)
 
     def handle_mouse_click(self):
-        if self.processed_img is None:
+        ws = g.workspace
+        if ws.origin_image is None:
             return jsonify({'error': 'No image available for processing'}), 400
 
         data = request.get_json()
         x = data['x']
         y = data['y']
         print(f'Point clicked at: {x}, {y}')
-        self.points.append(np.array([x, y], dtype=np.float32))
-        self.points_label.append(1 if self.mode == 'p_point' else 0)
+        with ws.lock:
+            ws.points.append(np.array([x, y], dtype=np.float32))
+            ws.points_label.append(1 if ws.mode == 'p_point' else 0)
 
-        # Add command to queue list
-        self.queue.append("point")
+            # Add command to queue list
+            ws.queue.append("point")
 
         # Process and return the image
         return f"Click at image pos {x}, {y}"
-    
+
     def handle_stroke_data(self):
+        ws = g.workspace
+        if ws.origin_image is None:
+            return jsonify({'error': 'No image available for processing'}), 400
+
         data = request.get_json()
         stroke_data = data['stroke_data']
 
         print("Received stroke data")
 
-        if len(stroke_data) == 0:
-            pass
-        else:
-            # Process the stroke data here
-            stroke_img = np.zeros_like(self.origin_image)
-            print(f"stroke data len: {len(stroke_data)}")
-
-            latestData = stroke_data[len(stroke_data) - 1]
-            strokes, size = latestData['Stroke'], latestData['Size']
-            BGRcolor = (latestData['Color']['b'], latestData['Color']['g'], latestData['Color']['r'])
-            Rpos, Bpos = 2, 0
-            stroke_data_cv2 = []
-            for stroke in strokes:
-                stroke_data_cv2.append((int(stroke['x']), int(stroke['y'])))
-            for i in range(len(strokes) - 1):
-                cv2.line(stroke_img, stroke_data_cv2[i], stroke_data_cv2[i + 1], BGRcolor, size)
-
-            if BGRcolor[0] == 255:
-                mask = np.squeeze(stroke_img[:, :, Bpos] == 0)
-                opt = "negative"
-            else: # np.where(BGRcolor == 255)[0] == Rpos
-                mask = np.squeeze(stroke_img[:, :, Rpos] > 0)
-                opt = "positive"
-
-            self.masks.append({
-                "mask": mask,
-                "opt": opt
-            })
-
-        self.get_colored_masks_image()
-        self.processed_img, maskedImage = self.updateMaskImg(self.origin_image, self.masks)
-        self.masked_img = maskedImage
-        self.queue.append("brush")
-
-        if self.curr_view == "masks":
-            print("view masks")
-            processed_image = self.masked_img
-        elif self.curr_view == "colorMasks":
-            print("view color")
-            processed_image = self.colorMasks
-        else:   # self.curr_view == "image":
-            print("view image")
-            processed_image = self.processed_img
+        with ws.lock:
+            if len(stroke_data) == 0:
+                pass
+            else:
+                # Process the stroke data here
+                stroke_img = np.zeros_like(ws.origin_image)
+                print(f"stroke data len: {len(stroke_data)}")
+
+                latestData = stroke_data[len(stroke_data) - 1]
+                strokes, size = latestData['Stroke'], latestData['Size']
+                BGRcolor = (latestData['Color']['b'], latestData['Color']['g'], latestData['Color']['r'])
+                Rpos, Bpos = 2, 0
+                stroke_data_cv2 = []
+                for stroke in strokes:
+                    stroke_data_cv2.append((int(stroke['x']), int(stroke['y'])))
+                for i in range(len(strokes) - 1):
+                    cv2.line(stroke_img, stroke_data_cv2[i], stroke_data_cv2[i + 1], BGRcolor, size)
+
+                if BGRcolor[0] == 255:
+                    mask = np.squeeze(stroke_img[:, :, Bpos] == 0)
+                    opt = "negative"
+                else: # np.where(BGRcolor == 255)[0] == Rpos
+                    mask = np.squeeze(stroke_img[:, :, Rpos] > 0)
+                    opt = "positive"
+
+                ws.layers.push(mask, opt)
+
+            ws.queue.append("brush")
+            return self.send_view(ws, ws.curr_view, data)
 
-        _, buffer = cv2.imencode('.jpg', processed_image)
-        img_base64 = base64.b64encode(buffer).decode('utf-8')
-        return jsonify({'image': img_base64})
-    
     def box_receive(self):
-        if self.processed_img is None:
+        ws = g.workspace
+        if ws.origin_image is None:
             return jsonify({'error': 'No image available for processing'}), 400
 
         data = request.get_json()
-        self.boxes.append(np.array([
-            data['x1'], data['y1'],
-            data['x2'], data['y2']
-        ], dtype=np.float32))
+        with ws.lock:
+            ws.boxes.append(np.array([
+                data['x1'], data['y1'],
+                data['x2'], data['y2']
+            ], dtype=np.float32))
 
-        # Add command to queue list
-        self.queue.append("box")
+            # Add command to queue list
+            ws.queue.append("box")
 
         return "server received boxes"
 
-    def process_image(self, image, info):
-        processed_image = image
+    def process_image(self, ws, info, data=None):
+        view = "image"
 
         if info['event'] == 'button_click':
             id = info['data']
             if (id == MODE.IAMGE):
-                self.curr_view = "image"
-                processed_image = self.processed_img
+                ws.curr_view = "image"
+                view = ws.curr_view
             elif (id == MODE.MASKS):
-                self.curr_view = "masks"
-                processed_image = self.masked_img
+                ws.curr_view = "masks"
+                view = ws.curr_view
             elif (id == MODE.COLOR_MASKS):
-                self.curr_view = "colorMasks"
-                processed_image = self.colorMasks
+                ws.curr_view = "colorMasks"
+                view = ws.curr_view
             elif (id == MODE.CLEAR):
-                processed_image = self.origin_image
-                self.processed_img = self.origin_image
-                self.reset_inputs()
-                self.reset_masks()  
-                self.queue.clear()
-                self.prev_inputs.clear()
+                # Without masks the image view is the origin image
+                ws.reset_inputs()
+                ws.reset_masks()
+                ws.queue.clear()
+                ws.prev_inputs.clear()
             elif (id == MODE.P_POINT):
-                self.mode = "p_point"
+                ws.mode = "p_point"
             elif (id == MODE.N_POINT):
-                self.mode = "n_point"
+                ws.mode = "n_point"
             elif (id == MODE.BOXES):
-                self.mode = "box"
+                ws.mode = "box"
             elif (id == MODE.INFERENCE):
                 print("INFERENCE")
-                # self.reset_masks()
-                points = np.array(self.points)
-                labels = np.array(self.points_label)
-                boxes = np.array(self.boxes)
+                # ws.reset_masks()
+                points = np.array(ws.points)
+                labels = np.array(ws.points_label)
+                boxes = np.array(ws.boxes)
                 print(f"Points shape {points.shape}")
                 print(f"Labels shape {labels.shape}")
                 print(f"Boxes shape {boxes.shape}")
-                prev_masks_len = len(self.masks)
-                processed_image, self.masked_img = self.inference(self.origin_image, points, labels, boxes)
-                curr_masks_len = len(self.masks)
-                self.get_colored_masks_image()
-                self.processed_img = processed_image
-                self.prev_inputs.append({
-                    "points": self.points,
-                    "labels": self.points_label,
-                    "boxes": self.boxes
-                })
-                self.reset_inputs()
-                self.queue.append(f"inference-{curr_masks_len - prev_masks_len}")
+                prev_masks_len = len(ws.masks)
+                self.inference(ws, ws.origin_image, points, labels, boxes)
+                self.finish_inference(ws, prev_masks_len)
 
             elif (id == MODE.UNDO):
-                if len(self.queue) != 0:
-                    command = self.queue.pop()
+                if len(ws.queue) != 0:
+                    command = ws.queue.pop()
                     command = command.split('-')
                 else:
                     command = None
@@ -363,196 +940,351 @@ class SAM_Web_App:
                 if command is None:
                     pass
                 elif command[0] == "point":
-                    self.points.pop()
-                    self.points_label.pop()
+                    ws.points.pop()
+                    ws.points_label.pop()
                 elif command[0] == "box":
-                    self.boxes.pop()
+                    ws.boxes.pop()
                 elif command[0] == "inference":
-                    # Calculate masks and image again
+                    # Remove the masks of this inference from the images
                     val = command[1]
-                    self.masks = self.masks[:(len(self.masks) - int(val))]
-                    self.processed_img, self.masked_img = self.updateMaskImg(self.origin_image, self.masks)
-                    self.get_colored_masks_image()
+                    ws.layers.pop(int(val))
 
                     # Load prev inputs
-                    prev_inputs = self.prev_inputs.pop()
-                    self.points = prev_inputs["points"]
-                    self.points_label = prev_inputs["labels"]
-                    self.boxes = prev_inputs["boxes"]
+                    prev_inputs = ws.prev_inputs.pop()
+                    ws.points = prev_inputs["points"]
+                    ws.points_label = prev_inputs["labels"]
+                    ws.boxes = prev_inputs["boxes"]
                 elif command[0] == "brush":
-                    self.masks.pop()
-                    self.processed_img, self.masked_img = self.updateMaskImg(self.origin_image, self.masks)
-                    self.get_colored_masks_image()
-                
-                if self.curr_view == "masks":
-                    print("view masks")
-                    processed_image = self.masked_img
-                elif self.curr_view == "colorMasks":
-                    print("view color")
-                    processed_image = self.colorMasks
-                else:   # self.curr_view == "image":
-                    print("view image")
-                    processed_image = self.processed_img
-
-        _, buffer = cv2.imencode('.jpg', processed_image)
-        img_base64 = base64.b64encode(buffer).decode('utf-8')
-        return jsonify({'image': img_base64})
-    
-    def inference(self, image, points, labels, boxes) -> np.ndarray:
-
-        points_len, lables_len, boxes_len = len(points), len(labels), len(boxes)
-        if (len(points) == len(labels) == 0):
-            points = labels = None
-        if (len(boxes) == 0):
-            boxes = None
-
-        # Image is set ?
-        if self.imgIsSet == False:
-            self.predictor.set_image(image, image_format="RGB")
-            self.imgIsSet = True
-            print("Image set!")
-
-        # Auto 
-        if (points_len == boxes_len == 0):
-            masks = self.autoPredictor.generate(image)
-            for mask in masks:
-                self.masks.append({
-                    "mask": mask,
-                    "opt": "positive"
-                })
+                    ws.layers.pop(1)
+
+                view = ws.curr_view
+
+        return self.send_view(ws, view, data)
+
+    def finish_inference(self, ws, prev_masks_len):
+        """ Record the masks pushed since prev_masks_len as one inference for undo """
+        curr_masks_len = len(ws.masks)
+        ws.prev_inputs.append({
+            "points": ws.points,
+            "labels": ws.points_label,
+            "boxes": ws.boxes
+        })
+        ws.reset_inputs()
+        ws.queue.append(f"inference-{curr_masks_len - prev_masks_len}")
+
+    def auto_stream(self):
+        """ Automatic mask generation as a stream of server-sent events
+
+        Each "frame" event carries a send_view response with the masks of one
+        more point batch drawn, so the first masks show up long before the whole
+        image is done. The event with "final": true swaps them for the final,
+        deduplicated masks, which are recorded for undo like a normal inference.
+        The session is locked until the stream ends. If it ends early, a "busy"
+        or "failed" event carries the error and, if it could be drawn, the
+        frame without the preliminary masks.
+        """
+        ws = g.workspace
+        if ws.origin_image is None:
+            return jsonify({'error': 'No image available for processing'}), 400
+        data = {'delta': True, 'frame': request.args.get('frame', type=int)}
+
+        def events():
+            with ws.lock:
+                print("INFERENCE (streaming)")
+                prev_masks_len = len(ws.masks)
+                stream, final = None, False
+                try:
+                    # The layer 0 crop is the whole image, so it shares the interactive embedding
+                    features = self.wait_embedding(ws)["features"]
+                    stream = self.autoPredictor.generate_stream(ws.origin_image, features=features)
+                    while not final:
+                        # Every step runs on the worker, so other sessions get their turn between batches
+                        update = self.worker.submit(next, stream).result()
+                        masks, final = update["masks"], update["final"]
+                        if final:
+                            ws.layers.pop(len(ws.masks) - prev_masks_len)
+                        for mask in masks:
+                            ws.layers.push(mask, "positive")
+                        if final:
+                            self.finish_inference(ws, prev_masks_len)
+
+                        response = self.encode_view(ws, "image", data)
+                        response['final'] = final
+                        data['frame'] = ws.frame_id     # The browser applies every event in order
+                        yield f"event: frame\ndata: {json.dumps(response)}\n\n"
+                except Exception as e:
+                    if isinstance(e, queue.Full):
+                        event, response = "busy", {'error': 'Server busy, too many inference requests queued'}
+                    else:
+                        print(f"Auto-segmentation failed: {e}")
+                        event, response = "failed", {'error': f"Auto-segmentation failed: {e}"}
+                    if not final:
+                        ws.layers.pop(len(ws.masks) - prev_masks_len)
+                    try:
+                        response.update(self.encode_view(ws, "image", data))
+                    except Exception:
+                        pass    # The browser keeps its frame, the error still gets through
+                    yield f"event: {event}\ndata: {json.dumps(response)}\n\n"
+                finally:
+                    if stream is not None:
+                        stream.close()
+                    if not final:
+                        # Stopped early, drop the preliminary masks
+                        ws.layers.pop(len(ws.masks) - prev_masks_len)
+
+        return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    def submit_amg_job(self):
+        """ Start auto-segmentation of the session's image in the background
+
+        Returns the job status with its "job_id" right away. A job still
+        running on the same image is returned instead of starting another.
+        """
+        ws = g.workspace
+        if ws.origin_image is None:
+            return jsonify({'error': 'No image available for processing'}), 400
+
+        with ws.lock:
+            for job in ws.jobs.values():
+                if not job.finished:
+                    return jsonify(job.status()), 202
+            embedding = ws.embedding if ws.embedding is not None else ws.embedding_future
+            job = AmgJob(self.autoPredictor, self.worker, ws.origin_image, embedding)
+            ws.jobs[job.id] = job
+            # Keep the results of a few finished jobs that were never collected
+            while len(ws.jobs) > 8:
+                oldest = next(iter(ws.jobs))
+                ws.jobs.pop(oldest).cancel()
+        print(f"Auto-segmentation job {job.id[:8]} submitted")
+        return jsonify(job.status()), 202
+
+    def amg_job_status(self, job_id):
+        job = g.workspace.jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown job'}), 404
+        return jsonify(job.status())
+
+    def cancel_amg_job(self, job_id):
+        job = g.workspace.jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown job'}), 404
+        job.cancel()
+        return jsonify(job.status())
+
+    def amg_job_result(self, job_id):
+        """ Add the masks of a finished job to the session as one inference
+
+        Takes the same "delta" and "frame" options as button clicks and
+        returns the image view like an inference does.
+        """
+        ws = g.workspace
+        data = request.get_json(silent=True) or {}
+        with ws.lock:
+            job = ws.jobs.get(job_id)
+            if job is None:
+                return jsonify({'error': 'Unknown job'}), 404
+            if job.state != "done":
+                return jsonify(job.status()), 409
+            ws.jobs.pop(job_id)
+
+            prev_masks_len = len(ws.masks)
+            for mask in job.masks:
+                ws.layers.push(mask, "positive")
+            self.finish_inference(ws, prev_masks_len)
+            return self.send_view(ws, "image", data)
+
+    def get_view_image(self, ws, view):
+        if view == "masks":
+            print("view masks")
+            return ws.masked_img
+        elif view == "colorMasks":
+            print("view color")
+            return ws.colorMasks
+        else:   # view == "image":
+            print("view image")
+            return ws.processed_img
+
+    def send_view(self, ws, view, data=None):
+        return jsonify(self.encode_view(ws, view, data))
+
+    def encode_view(self, ws, view, data=None) -> Dict[str, Any]:
+        """ Encode a view for the browser
+
+        Requests with "delta": true and the "frame" number the browser shows
+        get only the region changed since that frame, as a PNG patch with its
+        position, or no image at all if nothing changed. Everything else gets
+        the whole view as JPEG.
+        """
+        data = data or {}
+        processed_image = self.get_view_image(ws, view)
+        dirty = ws.layers.take_dirty()
+        h, w = processed_image.shape[:2]
+
+        full = not data.get('delta') or data.get('frame') != ws.frame_id or ws.sent_view != view
+        if not full and dirty is not None:
+            y0, y1, x0, x1 = dirty
+            full = (y1 - y0) * (x1 - x0) > 0.5 * h * w     # JPEG of the whole view is smaller
+        ws.sent_view = view
+        ws.frame_id += 1
+
+        if full:
+            _, buffer = cv2.imencode('.jpg', processed_image)
+            img_base64 = base64.b64encode(buffer).decode('utf-8')
+            return {'image': img_base64, 'frame': ws.frame_id}
+        if dirty is None:
+            return {'frame': ws.frame_id}
+
+        y0, y1, x0, x1 = dirty
+        _, buffer = cv2.imencode('.png', processed_image[y0:y1, x0:x1])
+        patch_base64 = base64.b64encode(buffer).decode('utf-8')
+        return {
+            'delta': {'x': x0, 'y': y0, 'width': x1 - x0, 'height': y1 - y0, 'image': patch_base64},
+            'frame': ws.frame_id,
+        }
+
+    def decode_request(self, embedding, points, labels, boxes) -> Dict[str, Any]:
+        """ Turn the prompts of one inference into a mask decoder request for decode_masks """
+        transform, original_size = self.predictor.transform, embedding["original_size"]
+        req = {"embedding": embedding, "coords": None, "labels": None, "boxes": None}
 
         # One Object
-        elif ((boxes_len == 1) or (points_len > 0 and boxes_len <= 1)):
-            masks, scores, logits = self.predictor.predict(
-                point_coords=points,
-                point_labels=labels,
-                box=boxes,
-                multimask_output=True,
-            )
-            max_idx = np.argmax(scores)
-            self.masks.append({
-                "mask": masks[max_idx],
-                "opt": "positive"
-            })
+        if ((len(boxes) == 1) or (len(points) > 0 and len(boxes) <= 1)):
+            if len(points) > 0:
+                req["coords"] = transform.apply_coords(points, original_size)[None, :, :]
+                req["labels"] = labels[None, :]
+            if len(boxes) == 1:
+                req["boxes"] = transform.apply_boxes(boxes, original_size)
+            req["multimask"] = True
 
         # Multiple Object
-        elif (boxes_len > 1):
-            boxes = torch.tensor(boxes, device=self.predictor.device)
-            transformed_boxes = self.predictor.transform.apply_boxes_torch(boxes, image.shape[:2])
-            masks, scores, logits = self.predictor.predict_torch(
-                point_coords=None,
-                point_labels=None,
-                boxes=transformed_boxes,
-                multimask_output=False,
+        else:
+            req["boxes"] = transform.apply_boxes(boxes, original_size)
+            req["multimask"] = False
+
+        req["num_prompts"] = len(req["boxes"] if req["coords"] is None else req["coords"])
+        return req
+
+    @staticmethod
+    def decode_batch_key(req):
+        """ Requests with the same prompt layout can share one decoder forward without padding """
+        num_points = 0 if req["coords"] is None else req["coords"].shape[1]
+        return (num_points, req["boxes"] is not None, req["multimask"])
+
+    @torch.no_grad()
+    def decode_masks(self, requests) -> List[List[np.ndarray]]:
+        """ Decode the best mask of every prompt of several requests in one mask decoder forward
+
+        Only called from the inference worker. All requests must share a decode_batch_key,
+        but may come from different sessions and images.
+        """
+        model = self.predictor.model
+        device = self.predictor.device
+        first = requests[0]
+
+        points, boxes = None, None
+        if first["coords"] is not None:
+            coords = torch.as_tensor(np.concatenate([r["coords"] for r in requests]), dtype=torch.float, device=device)
+            labels = torch.as_tensor(np.concatenate([r["labels"] for r in requests]), dtype=torch.int, device=device)
+            points = (coords, labels)
+        if first["boxes"] is not None:
+            boxes = torch.as_tensor(np.concatenate([r["boxes"] for r in requests]), dtype=torch.float, device=device)
+        features = torch.cat([
+            r["embedding"]["features"].to(device).expand(r["num_prompts"], -1, -1, -1) for r in requests
+        ])
+
+        sparse_embeddings, dense_embeddings = model.prompt_encoder(points=points, boxes=boxes, masks=None)
+        low_res_masks, iou_predictions = model.mask_decoder(
+            image_embeddings=features,
+            image_pe=model.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=first["multimask"],
+        )
+        if len(requests) > 1:
+            print(f"Decoded {len(requests)} requests in one batch")
+
+        # Upscale each request's masks to its image and keep the best one per prompt
+        results, start = [], 0
+        for r in requests:
+            end = start + r["num_prompts"]
+            embedding = r["embedding"]
+            masks = model.postprocess_masks(
+                low_res_masks[start:end], embedding["input_size"], embedding["original_size"]
             )
-            masks = masks.detach().cpu().numpy()
-            scores = scores.detach().cpu().numpy()
-            max_idxs = np.argmax(scores, axis=1)
-            print(f"output mask shape: {masks.shape}")  # (batch_size) x (num_predicted_masks_per_input) x H x W
-            for i in range(masks.shape[0]):
-                self.masks.append({
-                    "mask": masks[i][max_idxs[i]],
-                    "opt": "positive"
-                })
-
-        # Update masks image to show
-        overlayImage, maskedImage = self.updateMaskImg(self.origin_image, self.masks)
-        # overlayImage, maskedImage = self.updateMaskImg(overlayImage, maskedImage, [self.brushMask])
-
-        return overlayImage, maskedImage
-
-    def updateMaskImg(self, image, masks):
-
-        if (len(masks) == 0 or masks[0] is None):
-            print(masks)
-            return image, np.zeros_like(image)
-        
-        union_mask = np.zeros_like(image)[:, :, 0]
-        np.random.seed(0)
-        for i in range(len(masks)):
-            if masks[i]['opt'] == "negative":
-                image = self.clearMaskWithOriginImg(self.origin_image, image, masks[i]['mask'])
-                union_mask = np.bitwise_and(union_mask, masks[i]['mask'])
-            else:
-                image = self.overlay_mask(image, masks[i]['mask'], 0.5, random_color=(len(masks) > 1))
-                union_mask = np.bitwise_or(union_mask, masks[i]['mask'])
-        
-        # Cut out objects using union mask
-        masked_image = self.origin_image * union_mask[:, :, np.newaxis]
-        
-        return image, masked_image
-
-    # Function to overlay a mask on an image
-    def overlay_mask(
-        self, 
-        image: np.ndarray, 
-        mask: np.ndarray, 
-        alpha: float, 
-        random_color: bool = False,
-    ) -> np.ndarray:
-        """ Draw mask on origin image
+            best = iou_predictions[start:end].argmax(dim=1)
+            masks = masks[torch.arange(end - start, device=masks.device), best] > model.mask_threshold
+            results.append(list(masks.cpu().numpy()))
+            start = end
+        return results
+
+    def compute_embedding(self, image, image_key) -> Dict[str, Any]:
+        """ Run the image encoder on image, only called from the inference worker """
+        embedding = self.embeddings.get(image_key)
+        if embedding is not None:
+            return embedding
+
+        self.predictor.set_image(image, image_format="RGB")
+        embedding = {
+            "features": self.predictor.get_image_embedding(),
+            "input_size": self.predictor.input_size,
+            "original_size": self.predictor.original_size,
+        }
+        self.embeddings.put(image_key, embedding)
+        print("Image set!")
+        return embedding
 
-        parameters:
-        image:  Origin image
-        mask:   Mask that have same size as image
-        color:  Mask's color in BGR
-        alpha:  Transparent ratio from 0.0-1.0
+    def wait_embedding(self, ws) -> Dict[str, Any]:
+        """ Get the workspace's image embedding, waiting for the encoder if it is still running
 
-        return:
-        blended: masked image
+        A failed encoder job is forgotten, so the next request encodes again,
+        and one cancelled while waiting on it is submitted again.
         """
-        # Blend the image and the mask using the alpha value
-        if random_color:
-            color = np.random.random(3)
+        while ws.embedding is None:
+            future = ws.embedding_future
+            if future is None or future.cancelled():
+                future = ws.embedding_future = self.worker.submit(self.compute_embedding, ws.origin_image, ws.image_key)
+            try:
+                ws.embedding = future.result()
+            except CancelledError:
+                pass
+            finally:
+                if ws.embedding_future is future:
+                    ws.embedding_future = None
+        return ws.embedding
+
+    def inference(self, ws, image, points, labels, boxes) -> np.ndarray:
+        """ Predict masks for the prompts, push them to the workspace and return the overlay image """
+
+        # Auto
+        embedding = self.wait_embedding(ws)
+        if (len(points) == len(boxes) == 0):
+            # Stepped one point batch per worker call like the background jobs, so
+            # other sessions' requests run in between
+            masks = AmgJob(self.autoPredictor, self.worker, image, embedding).wait()
         else:
-            color = np.array([30/255, 144/255, 255/255])    # BGR
-        h, w = mask.shape[-2:]
-        mask = mask.reshape(h, w, 1) * color.reshape(1, 1, -1)
-        mask *= 255 * alpha
-        mask = mask.astype(dtype=np.uint8)
-        blended = cv2.add(image, mask)
-        
-        return blended
-    
-    def get_colored_masks_image(self):
-        masks = self.masks
-        darkImg = np.zeros_like(self.origin_image)
-        image = darkImg.copy()
-
-        np.random.seed(0)
-        if (len(masks) == 0):
-            self.colorMasks = image
-            return image
+            req = self.decode_request(embedding, points, labels, boxes)
+            masks = self.worker.submit_batched(self.decode_masks, req, self.decode_batch_key(req)).result()
+
         for mask in masks:
-            if mask['opt'] == "negative":
-                image = self.clearMaskWithOriginImg(darkImg, image, mask['mask'])
-            else:
-                image = self.overlay_mask(image, mask['mask'], 0.5, random_color=(len(masks) > 1))
-
-        self.colorMasks = image
-        return image
-    
-    def clearMaskWithOriginImg(self, originImage, image, mask):
-        originImgPart = originImage * np.invert(mask)[:, :, np.newaxis]
-        image = image * mask[:, :, np.newaxis]
-        image = cv2.add(image, originImgPart)
-        return image
-    
-    def reset_inputs(self):
-        self.points = []
-        self.points_label = []
-        self.boxes = []
+            ws.layers.push(mask, "positive")
 
-    def reset_masks(self):
-        self.masks = []
-        self.masked_img = np.zeros_like(self.origin_image)
-        self.colorMasks = np.zeros_like(self.origin_image)
+        # Masks were drawn incrementally while pushing them
+        return ws.processed_img
 
     def run(self, debug=True):
-        self.app.run(debug=debug, port=8989)
+        if self.args.production:
+            try:
+                from waitress import serve
+            except ImportError:
+                raise ImportError("--production requires waitress, run: pip install waitress")
+            print(f"Serving on http://{self.args.host}:{self.args.port} with {self.args.threads} threads")
+            serve(self.app, host=self.args.host, port=self.args.port, threads=self.args.threads)
+        else:
+            # The reloader would load the model a second time in its child process
+            self.app.run(debug=debug, host=self.args.host, port=self.args.port, use_reloader=False)
 
 
 if __name__ == '__main__':
     args = parser().parse_args()
     app = SAM_Web_App(args)
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=not args.production)
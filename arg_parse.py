@@ -8,6 +8,15 @@ def parser():
     parser.add_argument("--checkpoint", type=str, default="/home/ee904/DDFish/segment-anything/models/sam_vit_h_4b8939.pth")
     parser.add_argument("--device", type=str, default="cuda")
     parser.add_argument("--model_type", type=str, default="default")
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help=(
+            "Run the linear layers of the image encoder and mask decoder with int8 weights "
+            "and dynamically quantized activations. Faster on CPU at a small cost in mask "
+            "accuracy, see scripts/quantization_report.py. Requires --device cpu."
+        ),
+    )
     parser.add_argument(
         "--output",
         type=str,
@@ -26,6 +35,64 @@ def parser():
         ),
     )
 
+    server_settings = parser.add_argument_group("Server Settings")
+    server_settings.add_argument("--host", type=str, default="127.0.0.1")
+    server_settings.add_argument("--port", type=int, default=8989)
+    server_settings.add_argument(
+        "--production",
+        action="store_true",
+        help="Serve with the multi-threaded waitress WSGI server instead of the Flask debug server.",
+    )
+    server_settings.add_argument(
+        "--threads",
+        type=int,
+        default=8,
+        help="Number of request handler threads in production mode.",
+    )
+    server_settings.add_argument(
+        "--inference-queue-size",
+        type=int,
+        default=64,
+        help="Maximum number of model calls waiting for the inference worker, beyond it requests get a 503.",
+    )
+    server_settings.add_argument(
+        "--decoder-batch-window",
+        type=float,
+        default=2.0,
+        help="Milliseconds to wait for more mask decoder requests to batch with the first one.",
+    )
+    server_settings.add_argument(
+        "--decoder-max-batch",
+        type=int,
+        default=16,
+        help="Maximum number of mask decoder requests, from any sessions, run in one batch.",
+    )
+    server_settings.add_argument(
+        "--max-sessions",
+        type=int,
+        default=8,
+        help="Maximum number of annotation sessions kept in memory. Least recently used ones are evicted.",
+    )
+    server_settings.add_argument(
+        "--session-memory-limit",
+        type=float,
+        default=4096,
+        help=(
+            "Memory ceiling in MB for the images, masks and embeddings of all sessions together. "
+            "Least recently used sessions are evicted when it is exceeded."
+        ),
+    )
+
+    server_settings.add_argument(
+        "--embedding-cache-size",
+        type=float,
+        default=1024,
+        help=(
+            "Size in MB of the image embedding cache shared by all sessions. Re-uploading an "
+            "image whose embedding is cached skips the image encoder. Set to 0 to disable."
+        ),
+    )
+
     amg_settings = parser.add_argument_group("AMG Settings")
     amg_settings.add_argument(
         "--points-per-side",
@@ -99,5 +166,46 @@ def parser():
             "in pixels are removed by postprocessing."
         ),
     )
+    amg_settings.add_argument(
+        "--adaptive-sampling-levels",
+        type=int,
+        default=None,
+        help=(
+            "If >0, sample points coarse-to-fine over this many extra levels, skipping points "
+            "of finer levels that are already covered by a mask."
+        ),
+    )
+    amg_settings.add_argument(
+        "--crop-min-edge-density",
+        type=float,
+        default=None,
+        help="Skip image crops past the first layer with a smaller fraction of edge pixels.",
+    )
+    amg_settings.add_argument(
+        "--crop-max-coverage",
+        type=float,
+        default=None,
+        help=(
+            "Skip image crops past the first layer that are covered by masks from earlier "
+            "layers by more than this fraction."
+        ),
+    )
+    amg_settings.add_argument(
+        "--crops-per-batch",
+        type=int,
+        default=None,
+        help=(
+            "How many image crops of the same crop layer to run through the image encoder "
+            "simultaneously. Higher numbers may be faster but use more GPU memory."
+        ),
+    )
+    amg_settings.add_argument(
+        "--filter-at-low-res",
+        action="store_true",
+        help=(
+            "Filter masks by predicted IoU and stability before upscaling them, using "
+            "the stability of the low resolution logits. Faster and uses less memory."
+        ),
+    )
 
     return parser
\ No newline at end of file
@@ -0,0 +1,169 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict
+
+from segment_anything.modeling.image_encoder import Attention, add_decomposed_rel_pos
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Times one global attention block of the SAM image encoder and measures its "
+        "peak memory, with the fused and chunked attention against the previous "
+        "implementation that builds the whole attention map. Also checks that both "
+        "give the same output. Every run is a separate process, so that peak memory "
+        "can be read from its max RSS on CPU."
+    )
+)
+
+parser.add_argument(
+    "--models",
+    type=str,
+    nargs="+",
+    default=["vit_b", "vit_l", "vit_h"],
+    help="The image encoders whose attention blocks to time.",
+)
+
+parser.add_argument(
+    "--tokens",
+    type=int,
+    default=64,
+    help="Side of the token grid, 64 for the global attention blocks of a 1024 input.",
+)
+
+parser.add_argument(
+    "--repeats", type=int, default=3, help="Number of timed runs, the best one is reported."
+)
+
+parser.add_argument("--device", type=str, default="cpu", help="The device to run on.")
+
+parser.add_argument("--run-one", type=str, nargs=3, help=argparse.SUPPRESS)
+
+# Embedding dimension and number of heads of the attention blocks of each model
+MODELS = {"vit_b": (768, 12), "vit_l": (1024, 16), "vit_h": (1280, 16)}
+
+
+def reference_forward(attn: Attention, x: torch.Tensor) -> torch.Tensor:
+    """The forward pass of Attention as it was, with the whole attention map."""
+    B, H, W, _ = x.shape
+    qkv = attn.qkv(x).reshape(B, H * W, 3, attn.num_heads, -1).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv.reshape(3, B * attn.num_heads, H * W, -1).unbind(0)
+    scores = (q * attn.scale) @ k.transpose(-2, -1)
+    scores = add_decomposed_rel_pos(scores, q, attn.rel_pos_h, attn.rel_pos_w, (H, W), (H, W))
+    scores = scores.softmax(dim=-1)
+    x = (scores @ v).view(B, attn.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+    return attn.proj(x)
+
+
+def run_one(model: str, impl: str, out_path: str, args: argparse.Namespace) -> Dict[str, Any]:
+    torch.manual_seed(0)
+    dim, num_heads = MODELS[model]
+    attn = Attention(dim, num_heads, use_rel_pos=True, input_size=(args.tokens, args.tokens))
+    with torch.no_grad():
+        attn.rel_pos_h.normal_(std=0.5)
+        attn.rel_pos_w.normal_(std=0.5)
+    attn = attn.to(args.device).eval()
+    x = torch.randn(1, args.tokens, args.tokens, dim, device=args.device)
+    forward = attn if impl == "fused" else lambda x: reference_forward(attn, x)
+
+    with torch.no_grad():
+        forward(x)  # Warm up
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            out = forward(x)
+            if args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - start)
+    torch.save(out.cpu(), out_path)
+
+    if args.device.startswith("cuda"):
+        peak_mb = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        # ru_maxrss is in KB on Linux
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    return {"time": min(times), "peak_mb": peak_mb}
+
+
+def check_grad(model: str, tokens: int = 16) -> float:
+    """
+    Max abs difference of the outputs and of the gradients of the input and the relative
+    positional embeddings between both implementations, with autograd enabled.
+    """
+    torch.manual_seed(0)
+    dim, num_heads = MODELS[model]
+    attn = Attention(dim, num_heads, use_rel_pos=True, input_size=(tokens, tokens))
+    with torch.no_grad():
+        attn.rel_pos_h.normal_(std=0.5)
+        attn.rel_pos_w.normal_(std=0.5)
+    x = torch.randn(1, tokens, tokens, dim)
+    grad_out = torch.randn(1, tokens, tokens, dim)
+
+    results = []
+    for forward in [lambda x: reference_forward(attn, x), attn]:
+        attn.zero_grad()
+        x_leaf = x.clone().requires_grad_()
+        out = forward(x_leaf)
+        out.backward(grad_out)
+        results.append([out.detach(), x_leaf.grad, attn.rel_pos_h.grad, attn.rel_pos_w.grad])
+    return max((a - b).abs().max().item() for a, b in zip(*results))
+
+
+def main(args: argparse.Namespace) -> None:
+    print(
+        f"Global attention over {args.tokens}x{args.tokens} tokens on {args.device}, "
+        f"best of {args.repeats}"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for model in args.models:
+            results = {}
+            for impl in ["reference", "fused"]:
+                out_path = os.path.join(tmp, f"{model}_{impl}.pt")
+                cmd = [sys.executable, __file__, "--run-one", model, impl, out_path]
+                cmd += ["--tokens", str(args.tokens), "--repeats", str(args.repeats)]
+                cmd += ["--device", args.device]
+                proc = subprocess.run(cmd, capture_output=True, text=True)
+                if proc.returncode != 0:
+                    print(f"{model} {impl}: failed, likely out of memory ({proc.returncode})")
+                    continue
+                results[impl] = json.loads(proc.stdout.strip().splitlines()[-1])
+                results[impl]["out"] = torch.load(out_path)
+
+            if len(results) < 2:
+                for impl, r in results.items():
+                    print(f"{model} {impl}: {r['time'] * 1000:.0f} ms, {r['peak_mb']:.0f} MB peak")
+                continue
+            ref, fused = results["reference"], results["fused"]
+            max_diff = (ref["out"] - fused["out"]).abs().max().item()
+            print(
+                f"{model}: reference {ref['time'] * 1000:.0f} ms, {ref['peak_mb']:.0f} MB peak | "
+                f"fused {fused['time'] * 1000:.0f} ms, {fused['peak_mb']:.0f} MB peak | "
+                f"{ref['time'] / fused['time']:.1f}x faster, max abs diff {max_diff:.2e}"
+            )
+            print(
+                f"{model}: max abs diff of outputs and gradients with autograd {check_grad(model):.2e}"
+            )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.run_one is not None:
+        model, impl, out_path = args.run_one
+        print(json.dumps(run_one(model, impl, out_path, args)))
+    else:
+        main(args)
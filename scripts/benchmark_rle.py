@@ -0,0 +1,139 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import argparse
+import time
+from typing import Any, Callable, Dict, List
+
+from segment_anything.utils.amg import batched_rle_to_mask, mask_to_rle_pytorch, rle_to_mask
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Times the RLE encoding of a batch of masks, as done for every point batch "
+        "by SamAutomaticMaskGenerator, and the decoding of the RLEs back to binary "
+        "masks, against the previous per-mask and per-run loops."
+    )
+)
+
+parser.add_argument(
+    "--sizes",
+    type=str,
+    nargs="+",
+    default=["1024x1024", "2160x3840"],
+    help="Mask sizes to time, as HxW.",
+)
+
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=192,
+    help="Number of masks encoded at once. AMG encodes up to points_per_batch * 3.",
+)
+
+parser.add_argument(
+    "--repeats", type=int, default=5, help="Number of timed runs, the best one is reported."
+)
+
+parser.add_argument("--device", type=str, default="cpu", help="The device to run on.")
+
+
+def mask_to_rle_loop(tensor: torch.Tensor) -> List[Dict[str, Any]]:
+    """The per-mask encoder that mask_to_rle_pytorch used to be."""
+    b, h, w = tensor.shape
+    tensor = tensor.permute(0, 2, 1).flatten(1)
+    diff = tensor[:, 1:] ^ tensor[:, :-1]
+    change_indices = diff.nonzero()
+    out = []
+    for i in range(b):
+        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
+        cur_idxs = torch.cat(
+            [
+                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
+                cur_idxs + 1,
+                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
+            ]
+        )
+        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
+        counts = [] if tensor[i, 0] == 0 else [0]
+        counts.extend(btw_idxs.detach().cpu().tolist())
+        out.append({"size": [h, w], "counts": counts})
+    return out
+
+
+def rle_to_mask_loop(rle: Dict[str, Any]) -> np.ndarray:
+    """The per-run decoder that rle_to_mask used to be."""
+    h, w = rle["size"]
+    mask = np.empty(h * w, dtype=bool)
+    idx = 0
+    parity = False
+    for count in rle["counts"]:
+        mask[idx : idx + count] = parity
+        idx += count
+        parity ^= True
+    mask = mask.reshape(w, h)
+    return mask.transpose()
+
+
+def make_masks(b: int, h: int, w: int, device: str) -> torch.Tensor:
+    """Random ellipses, a rough stand-in for SAM masks."""
+    rng = np.random.RandomState(0)
+    ys = torch.arange(h, device=device, dtype=torch.float32)[:, None]
+    xs = torch.arange(w, device=device, dtype=torch.float32)[None, :]
+    masks = torch.empty((b, h, w), dtype=torch.bool, device=device)
+    for i in range(b):
+        cy, cx = rng.uniform(0, h), rng.uniform(0, w)
+        ry, rx = rng.uniform(0.02, 0.3) * h, rng.uniform(0.02, 0.3) * w
+        masks[i] = ((ys - cy) / ry) ** 2 + ((xs - cx) / rx) ** 2 <= 1
+    return masks
+
+
+def best_time(fn: Callable, repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(args: argparse.Namespace) -> None:
+    print(f"{args.batch_size} masks on {args.device}, best of {args.repeats}")
+    for size in args.sizes:
+        h, w = (int(v) for v in size.split("x"))
+        masks = make_masks(args.batch_size, h, w, args.device)
+        assert mask_to_rle_pytorch(masks) == mask_to_rle_loop(masks), "Encoders disagree"
+
+        loop = best_time(lambda: mask_to_rle_loop(masks), args.repeats)
+        batched = best_time(lambda: mask_to_rle_pytorch(masks), args.repeats)
+        print(
+            f"Encode {h}x{w}: per-mask loop {loop * 1000:.1f} ms, batched {batched * 1000:.1f} ms, "
+            f"{loop / batched:.1f}x faster"
+        )
+
+        rles = mask_to_rle_pytorch(masks)
+        masks = masks.cpu().numpy()
+        assert np.array_equal(batched_rle_to_mask(rles), masks), "Decoders disagree"
+        # Old masks were transposed views, made contiguous as any consumer would
+        loop = best_time(
+            lambda: [np.ascontiguousarray(rle_to_mask_loop(rle)) for rle in rles], args.repeats
+        )
+        single = best_time(lambda: [rle_to_mask(rle) for rle in rles], args.repeats)
+        batched = best_time(lambda: batched_rle_to_mask(rles), args.repeats)
+        print(
+            f"Decode {h}x{w}: per-run loop {loop * 1000:.1f} ms, vectorized {single * 1000:.1f} ms, "
+            f"batched {batched * 1000:.1f} ms, {loop / batched:.1f}x faster"
+        )
+        del masks, rles
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,176 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import cv2  # type: ignore
+import numpy as np
+import torch
+
+import argparse
+import copy
+import io
+import os
+import time
+from typing import Dict, List, Tuple
+
+from segment_anything import SamPredictor, quantize_sam, sam_model_registry
+from segment_anything.utils.amg import build_point_grid
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Compares SAM with int8 dynamically quantized linear layers against the fp32 model "
+        "on a fixed set of images. Every image is prompted with a grid of single points, "
+        "and the masks of the quantized model are scored by their IoU with the fp32 masks "
+        "for the same prompt. Also reports the encoder and decoder time of both models."
+    )
+)
+
+parser.add_argument(
+    "--checkpoint",
+    type=str,
+    required=True,
+    help="The path to the SAM checkpoint to compare.",
+)
+
+parser.add_argument(
+    "--model-type",
+    type=str,
+    default="vit_h",
+    help="The type of model to load, in ['default', 'vit_h', 'vit_l', 'vit_b']",
+)
+
+parser.add_argument(
+    "--images",
+    type=str,
+    nargs="+",
+    required=True,
+    help="Images, or folders of images, to compare on. Folders are read in sorted order.",
+)
+
+parser.add_argument(
+    "--points-per-side",
+    type=int,
+    default=4,
+    help="Side of the grid of point prompts on every image.",
+)
+
+parser.add_argument(
+    "--threads",
+    type=int,
+    default=None,
+    help="Number of CPU threads for torch, all of them by default.",
+)
+
+
+def list_images(paths: List[str]) -> List[str]:
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(f for f in os.listdir(path) if not f.startswith("."))
+            images += [os.path.join(path, f) for f in names]
+        else:
+            images.append(path)
+    return images
+
+
+def state_dict_mb(module: torch.nn.Module) -> float:
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def run(
+    predictor: SamPredictor, image: np.ndarray, points: np.ndarray
+) -> Tuple[torch.Tensor, torch.Tensor, float, float]:
+    """Returns the masks and scores for every point prompt, and the encoder and decoder times."""
+    start = time.perf_counter()
+    predictor.set_image(image)
+    encoder_time = time.perf_counter() - start
+
+    coords = predictor.transform.apply_coords(points, image.shape[:2])
+    coords = torch.as_tensor(coords, dtype=torch.float, device=predictor.device)[:, None, :]
+    labels = torch.ones(coords.shape[:2], dtype=torch.int, device=predictor.device)
+    start = time.perf_counter()
+    masks, scores, _ = predictor.predict_torch(coords, labels, multimask_output=True)
+    decoder_time = time.perf_counter() - start
+    return masks, scores, encoder_time, decoder_time
+
+
+def mask_iou(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    intersection = (a & b).flatten(-2).sum(-1)
+    union = (a | b).flatten(-2).sum(-1)
+    # Two empty masks agree perfectly
+    return torch.where(union > 0, intersection / union.clamp(min=1), torch.ones_like(union).float())
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    print("Loading model...")
+    sam = sam_model_registry[args.model_type](checkpoint=args.checkpoint)
+    sam_int8 = quantize_sam(copy.deepcopy(sam))
+    predictors = {"fp32": SamPredictor(sam), "int8": SamPredictor(sam_int8)}
+
+    with torch.no_grad():
+        for predictor in predictors.values():
+            # Warm up
+            run(predictor, np.zeros((64, 64, 3), dtype=np.uint8), np.array([[32.0, 32.0]]))
+
+    images = list_images(args.images)
+    times: Dict[str, Dict[str, List[float]]] = {
+        name: {"encoder": [], "decoder": []} for name in predictors
+    }
+    ious: List[torch.Tensor] = []
+    top_ious: List[torch.Tensor] = []
+    for path in images:
+        image = cv2.imread(path)
+        if image is None:
+            print(f"Could not load '{path}' as an image, skipping...")
+            continue
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        points = build_point_grid(args.points_per_side) * np.array(image.shape[1::-1])[None, :]
+
+        masks: Dict[str, torch.Tensor] = {}
+        top: Dict[str, torch.Tensor] = {}
+        with torch.no_grad():
+            for name, predictor in predictors.items():
+                masks[name], scores, encoder_time, decoder_time = run(predictor, image, points)
+                # A click shows the highest scoring of the three masks
+                top[name] = masks[name][torch.arange(len(scores)), scores.argmax(dim=1)]
+                times[name]["encoder"].append(encoder_time)
+                times[name]["decoder"].append(decoder_time)
+        iou = mask_iou(masks["fp32"], masks["int8"]).cpu()
+        ious.append(iou.flatten())
+        top_ious.append(mask_iou(top["fp32"], top["int8"]).cpu())
+        print(
+            f"{os.path.basename(path)}: mean IoU {iou.mean().item():.4f}, "
+            f"min IoU {iou.min().item():.4f}, encoder "
+            f"{times['fp32']['encoder'][-1]:.2f} s fp32 / {times['int8']['encoder'][-1]:.2f} s int8"
+        )
+
+    if len(ious) == 0:
+        print("No images to compare on.")
+        return
+    all_ious = torch.cat(ious).numpy()
+    print()
+    print(f"{args.model_type} on {len(ious)} images, {len(all_ious)} masks per model")
+    print(
+        f"Mask IoU of int8 against fp32: mean {all_ious.mean():.4f}, "
+        f"5th percentile {np.percentile(all_ious, 5):.4f}, min {all_ious.min():.4f}, "
+        f"highest scoring mask mean {torch.cat(top_ious).mean().item():.4f}"
+    )
+    for stage in ["encoder", "decoder"]:
+        fp32, int8 = np.mean(times["fp32"][stage]), np.mean(times["int8"][stage])
+        print(
+            f"{stage.capitalize()} time: fp32 mean {fp32:.3f} s, int8 mean {int8:.3f} s, "
+            f"{fp32 / int8:.2f}x faster"
+        )
+    print(f"Weights: fp32 {state_dict_mb(sam):.0f} MB, int8 {state_dict_mb(sam_int8):.0f} MB")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -8,24 +8,26 @@ import numpy as np
 import torch
 from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 
-from typing import Any, Dict, List, Optional, Tuple
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Generator, Iterator, List, Optional, Tuple
 
 from .modeling import Sam
 from .predictor import SamPredictor
 from .utils.amg import (
     MaskData,
-    area_from_rle,
+    RleBuffer,
     batch_iterator,
     batched_mask_to_box,
     box_xyxy_to_xywh,
     build_all_layer_point_grids,
     calculate_stability_score,
     coco_encode_rle,
+    crop_edge_density,
     generate_crop_boxes,
     is_box_near_crop_edge,
-    mask_to_rle_pytorch,
+    point_grid_levels,
     remove_small_regions,
-    rle_to_mask,
     uncrop_boxes_xyxy,
     uncrop_masks,
     uncrop_points,
@@ -49,6 +51,11 @@ class SamAutomaticMaskGenerator:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        filter_at_low_res: bool = False,
+        crops_per_batch: int = 1,
+        adaptive_sampling_levels: int = 0,
+        crop_min_edge_density: float = 0.0,
+        crop_max_coverage: float = 1.0,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -90,9 +97,38 @@ class SamAutomaticMaskGenerator:
             to remove disconnected regions and holes in masks with area smaller
             than min_mask_region_area. Requires opencv.
           output_mode (str): The form masks are returned in. Can be 'binary_mask',
-            'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
-            For large resolutions, 'binary_mask' may consume large amounts of
-            memory.
+            'cropped_binary_mask', 'uncompressed_rle', or 'coco_rle'. 'coco_rle'
+            requires pycocotools. For large resolutions, 'binary_mask' may
+            consume large amounts of memory. 'cropped_binary_mask' returns
+            only the part of each binary mask inside its box. In both binary
+            modes masks stay binary arrays throughout and are never run-length
+            encoded.
+          filter_at_low_res (bool): If true, masks are filtered by predicted
+            IoU and stability before they are upscaled to the image size, and
+            the stability score is calculated on the low resolution logits
+            (256x256 for SAM). Only the masks that pass are upscaled, which
+            saves most of the memory and time spent per batch, at the cost
+            of slightly different stability scores.
+          crops_per_batch (int): Sets the number of image crops of the same
+            crop layer run through the image encoder simultaneously. Higher
+            numbers may be faster but use more GPU memory. On GPU, the next
+            batch of crops is encoded while masks of the current one are
+            being decoded.
+          adaptive_sampling_levels (int): If >0, the points of each crop are
+            sampled coarse-to-fine instead of all at once. The first level
+            takes every (2**adaptive_sampling_levels)th point of the grid
+            along both sides, and each next level halves that spacing.
+            Points of a finer level that fall inside a mask which already
+            passed filtering are skipped, which saves most decoder runs on
+            images of a few large objects.
+          crop_min_edge_density (float): Crops past the first layer are
+            skipped if the fraction of their pixels on an edge, where the
+            gray level changes by more than 8 to the next pixel, is below
+            this. Uniform regions like sky are rarely worth an encoder run.
+          crop_max_coverage (float): Crops past the first layer are skipped
+            if more than this fraction of them is covered by masks from
+            earlier layers. If <1, each layer of crops is only encoded once
+            the previous layer is done.
         """
 
         assert (points_per_side is None) != (
@@ -111,6 +147,7 @@ class SamAutomaticMaskGenerator:
 
         assert output_mode in [
             "binary_mask",
+            "cropped_binary_mask",
             "uncompressed_rle",
             "coco_rle",
         ], f"Unknown output_mode {output_mode}."
@@ -132,21 +169,34 @@ class SamAutomaticMaskGenerator:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.filter_at_low_res = filter_at_low_res
+        self.crops_per_batch = crops_per_batch
+        self.adaptive_sampling_levels = adaptive_sampling_levels
+        self.crop_min_edge_density = crop_min_edge_density
+        self.crop_max_coverage = crop_max_coverage
 
     @torch.no_grad()
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
+    def generate(
+        self, image: np.ndarray, image_embedding: Optional[torch.Tensor] = None
+    ) -> List[Dict[str, Any]]:
         """
         Generates masks for the given image.
 
         Arguments:
           image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          image_embedding (torch.Tensor or None): The embedding of the whole
+            image, as returned by 'get_image_embedding' of a SamPredictor
+            using the same model after 'set_image(image)'. If given, the
+            image encoder is not run again for the first crop layer.
 
         Returns:
            list(dict(str, any)): A list over records for masks. Each record is
              a dict containing the following keys:
                segmentation (dict(str, any) or np.ndarray): The mask. If
-                 output_mode='binary_mask', is an array of shape HW. Otherwise,
-                 is a dictionary containing the RLE.
+                 output_mode='binary_mask', is an array of shape HW. If
+                 output_mode='cropped_binary_mask', is the part of that array
+                 inside bbox, of shape (h + 1)x(w + 1). Otherwise, is a
+                 dictionary containing the RLE.
                bbox (list(float)): The box around the mask, in XYWH format.
                area (int): The area in pixels of the mask.
                predicted_iou (float): The model's own prediction of the mask's
@@ -160,7 +210,7 @@ class SamAutomaticMaskGenerator:
         """
 
         # Generate masks
-        mask_data = self._generate_masks(image)
+        mask_data = self._generate_masks(image, image_embedding)
 
         # Filter small disconnected regions and holes in masks
         if self.min_mask_region_area > 0:
@@ -168,22 +218,101 @@ class SamAutomaticMaskGenerator:
                 mask_data,
                 self.min_mask_region_area,
                 max(self.box_nms_thresh, self.crop_nms_thresh),
+                image.shape[:2],
             )
 
+        return self._write_records(mask_data, image.shape[:2])
+
+    @torch.no_grad()
+    def generate_stream(
+        self,
+        image: np.ndarray,
+        preview: bool = True,
+        image_embedding: Optional[torch.Tensor] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Generates masks for the given image like 'generate', but yields them
+        as soon as each batch of points has been processed instead of only
+        after the whole image is done. Masks from different batches have not
+        been deduplicated against each other yet, so the last update replaces
+        all earlier ones with the final masks.
+
+        Arguments:
+          image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          preview (bool): If False, intermediate updates carry no records and
+            only report progress.
+          image_embedding (torch.Tensor or None): The embedding of the whole
+            image, used like in 'generate'.
+
+        Yields:
+           dict(str, any): An update containing the following keys:
+             records (list(dict(str, any))): Mask records in the format
+               returned by 'generate'. For intermediate updates, the masks
+               that passed filtering in the batch just processed. For the
+               last update, the final masks, same as returned by 'generate'.
+             final (bool): Whether this is the last update.
+             crops_done (int): The number of finished image crops.
+             num_crops (int): The total number of image crops.
+             batches_done (int): The number of processed point batches,
+               over all crops. Batches skipped by adaptive sampling count
+               as processed once their crop is done.
+             num_batches (int): The total number of point batches.
+        """
+        stream = self._generate_masks_stream(image, image_embedding)
+        while True:
+            try:
+                progress, batch_data = next(stream)
+            except StopIteration as stop:
+                mask_data = stop.value
+                break
+            records = self._write_records(batch_data, image.shape[:2]) if preview else []
+            yield dict(records=records, final=False, **progress)
+
+        # Filter small disconnected regions and holes in masks
+        if self.min_mask_region_area > 0:
+            mask_data = self.postprocess_small_regions(
+                mask_data,
+                self.min_mask_region_area,
+                max(self.box_nms_thresh, self.crop_nms_thresh),
+                image.shape[:2],
+            )
+
+        progress["crops_done"] = progress["num_crops"]
+        progress["batches_done"] = progress["num_batches"]
+        yield dict(records=self._write_records(mask_data, image.shape[:2]), final=True, **progress)
+
+    @property
+    def _keeps_crops(self) -> bool:
+        # Binary output modes keep masks as crops of their boxes instead of RLEs
+        return self.output_mode in ["binary_mask", "cropped_binary_mask"]
+
+    def _write_records(
+        self, mask_data: MaskData, orig_size: Tuple[int, ...]
+    ) -> List[Dict[str, Any]]:
         # Encode masks
+        if self._keeps_crops:
+            areas = [int(crop.sum()) for crop in mask_data["crops"]]
+        else:
+            areas = mask_data["rles"].areas().tolist()
         if self.output_mode == "coco_rle":
             mask_data["segmentations"] = [coco_encode_rle(rle) for rle in mask_data["rles"]]
         elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
+            masks = np.zeros((len(mask_data["crops"]), *orig_size), dtype=bool)
+            for mask, crop, box in zip(masks, mask_data["crops"], mask_data["boxes"]):
+                x0, y0 = int(box[0]), int(box[1])
+                mask[y0 : y0 + crop.shape[0], x0 : x0 + crop.shape[1]] = crop
+            mask_data["segmentations"] = list(masks)
+        elif self.output_mode == "cropped_binary_mask":
+            mask_data["segmentations"] = mask_data["crops"]
         else:
-            mask_data["segmentations"] = mask_data["rles"]
+            mask_data["segmentations"] = list(mask_data["rles"])
 
         # Write mask records
         curr_anns = []
         for idx in range(len(mask_data["segmentations"])):
             ann = {
                 "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
+                "area": areas[idx],
                 "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
                 "predicted_iou": mask_data["iou_preds"][idx].item(),
                 "point_coords": [mask_data["points"][idx].tolist()],
@@ -194,17 +323,78 @@ class SamAutomaticMaskGenerator:
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    def _generate_masks(
+        self, image: np.ndarray, image_embedding: Optional[torch.Tensor] = None
+    ) -> MaskData:
+        stream = self._generate_masks_stream(image, image_embedding)
+        while True:
+            try:
+                next(stream)
+            except StopIteration as stop:
+                return stop.value
+
+    def _generate_masks_stream(
+        self, image: np.ndarray, image_embedding: Optional[torch.Tensor] = None
+    ) -> Generator[Tuple[Dict[str, int], MaskData], None, MaskData]:
+        """
+        Yields the progress and the masks of every processed point batch,
+        already in the original image frame, then returns all masks after
+        removing duplicates.
+        """
         orig_size = image.shape[:2]
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
+        progress = {
+            "crops_done": 0,
+            "num_crops": len(crop_boxes),
+            "batches_done": 0,
+            "num_batches": sum(self._num_batches(layer_idx) for layer_idx in layer_idxs),
+        }
+
+        # Coverage by earlier layers is only known once they are done
+        if self.crop_max_coverage < 1:
+            crop_groups = [
+                [i for i in range(len(crop_boxes)) if layer_idxs[i] == layer_idx]
+                for layer_idx in sorted(set(layer_idxs))
+            ]
+        else:
+            crop_groups = [list(range(len(crop_boxes)))]
 
         # Iterate over image crops
         data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+        for crop_group in crop_groups:
+            kept_idxs = []
+            for i in crop_group:
+                if self._skips_crop(image, crop_boxes[i], layer_idxs[i], data):
+                    progress["crops_done"] += 1
+                    progress["batches_done"] += self._num_batches(layer_idxs[i])
+                else:
+                    kept_idxs.append(i)
+            crop_embeddings = self._encode_crops_stream(
+                image,
+                [crop_boxes[i] for i in kept_idxs],
+                [layer_idxs[i] for i in kept_idxs],
+                image_embedding,
+            )
+            for i, (features, input_size) in zip(kept_idxs, crop_embeddings):
+                crop_box, layer_idx = crop_boxes[i], layer_idxs[i]
+                crop_stream = self._process_crop_stream(
+                    image, crop_box, layer_idx, orig_size, features, input_size
+                )
+                batches_before = progress["batches_done"]
+                while True:
+                    try:
+                        batch_data = next(crop_stream)
+                    except StopIteration as stop:
+                        crop_data = stop.value
+                        break
+                    progress["batches_done"] += 1
+                    yield dict(progress), batch_data
+                data.cat(crop_data)
+                progress["crops_done"] += 1
+                # Batches skipped by adaptive sampling count as done
+                progress["batches_done"] = batches_before + self._num_batches(layer_idx)
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -222,6 +412,114 @@ class SamAutomaticMaskGenerator:
         data.to_numpy()
         return data
 
+    def _skips_crop(
+        self, image: np.ndarray, crop_box: List[int], crop_layer_idx: int, data: MaskData
+    ) -> bool:
+        if crop_layer_idx == 0:
+            return False
+        if self.crop_min_edge_density > 0:
+            if crop_edge_density(image, crop_box) < self.crop_min_edge_density:
+                return True
+        if self.crop_max_coverage < 1:
+            if self._crop_coverage(data, crop_box) > self.crop_max_coverage:
+                return True
+        return False
+
+    def _crop_coverage(self, data: MaskData, crop_box: List[int]) -> float:
+        # The fraction of the crop covered by the masks in data
+        if "boxes" not in data:
+            return 0.0
+        x0, y0, x1, y1 = crop_box
+        covered = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        for i, (bx0, by0, bx1, by1) in enumerate(data["boxes"].tolist()):
+            ix0, iy0, ix1, iy1 = max(bx0, x0), max(by0, y0), min(bx1 + 1, x1), min(by1 + 1, y1)
+            if ix0 >= ix1 or iy0 >= iy1:
+                continue
+            if self._keeps_crops:
+                mask = data["crops"][i][iy0 - by0 : iy1 - by0, ix0 - bx0 : ix1 - bx0]
+            else:
+                mask = data["rles"].to_mask(i, [ix0, iy0, ix1, iy1])
+            covered[iy0 - y0 : iy1 - y0, ix0 - x0 : ix1 - x0] |= mask
+        return float(covered.mean())
+
+    def _point_levels(self, crop_layer_idx: int) -> np.ndarray:
+        return point_grid_levels(self.point_grids[crop_layer_idx], self.adaptive_sampling_levels)
+
+    def _num_batches(self, crop_layer_idx: int) -> int:
+        # At most, as adaptive sampling may skip some
+        _, level_sizes = np.unique(self._point_levels(crop_layer_idx), return_counts=True)
+        return int(sum(-(-size // self.points_per_batch) for size in level_sizes))
+
+    def _encode_crops_stream(
+        self,
+        image: np.ndarray,
+        crop_boxes: List[List[int]],
+        layer_idxs: List[int],
+        image_embedding: Optional[torch.Tensor] = None,
+    ) -> Iterator[Tuple[torch.Tensor, Tuple[int, ...]]]:
+        """
+        Yields the image embedding and input size of every crop, encoding
+        crops of the same layer in batches. On GPU, the next batch is
+        encoded on a side stream while the current one is being used.
+        The crop of the whole image uses image_embedding, if given.
+        """
+        im_h, im_w = image.shape[:2]
+        if image_embedding is not None and crop_boxes[:1] == [[0, 0, im_w, im_h]]:
+            input_size = self.predictor.transform.get_preprocess_shape(
+                im_h, im_w, self.predictor.transform.target_length
+            )
+            yield image_embedding.to(self.predictor.device), tuple(input_size)
+            crop_boxes, layer_idxs = crop_boxes[1:], layer_idxs[1:]
+
+        batches = []
+        for layer_idx in sorted(set(layer_idxs)):
+            layer_boxes = [box for box, idx in zip(crop_boxes, layer_idxs) if idx == layer_idx]
+            for (boxes,) in batch_iterator(self.crops_per_batch, layer_boxes):
+                batches.append(boxes)
+        if len(batches) == 0:
+            return
+        if self.predictor.device.type != "cuda":
+            for boxes in batches:
+                yield from self._encode_crops(image, boxes)
+            return
+
+        side_stream = torch.cuda.Stream(self.predictor.device)
+
+        def encode(boxes: List[List[int]]) -> List[Tuple[torch.Tensor, Tuple[int, ...]]]:
+            with torch.cuda.stream(side_stream):
+                encoded = self._encode_crops(image, boxes)
+            side_stream.synchronize()
+            return encoded
+
+        with ThreadPoolExecutor(max_workers=1) as encoder:
+            pending = encoder.submit(encode, batches[0])
+            for i in range(len(batches)):
+                encoded = pending.result()
+                if i + 1 < len(batches):
+                    pending = encoder.submit(encode, batches[i + 1])
+                for features, input_size in encoded:
+                    features.record_stream(torch.cuda.current_stream(self.predictor.device))
+                    yield features, input_size
+
+    @torch.no_grad()
+    def _encode_crops(
+        self, image: np.ndarray, crop_boxes: List[List[int]]
+    ) -> List[Tuple[torch.Tensor, Tuple[int, ...]]]:
+        # Like predictor.set_image, for a batch of crops
+        model = self.predictor.model
+        input_images, input_sizes = [], []
+        for x0, y0, x1, y1 in crop_boxes:
+            cropped_im = image[y0:y1, x0:x1, :]
+            if model.image_format != "RGB":
+                cropped_im = cropped_im[..., ::-1]
+            input_image = self.predictor.transform.apply_image(cropped_im)
+            input_image_torch = torch.as_tensor(input_image, device=self.predictor.device)
+            input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+            input_images.append(model.preprocess(input_image_torch))
+            input_sizes.append(tuple(input_image.shape[:2]))
+        features = model.image_encoder(torch.cat(input_images))
+        return [(features[i : i + 1], input_size) for i, input_size in enumerate(input_sizes)]
+
     def _process_crop(
         self,
         image: np.ndarray,
@@ -229,22 +527,70 @@ class SamAutomaticMaskGenerator:
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
     ) -> MaskData:
-        # Crop the image and calculate embeddings
+        crop_stream = self._process_crop_stream(image, crop_box, crop_layer_idx, orig_size)
+        while True:
+            try:
+                next(crop_stream)
+            except StopIteration as stop:
+                return stop.value
+
+    def _process_crop_stream(
+        self,
+        image: np.ndarray,
+        crop_box: List[int],
+        crop_layer_idx: int,
+        orig_size: Tuple[int, ...],
+        features: Optional[torch.Tensor] = None,
+        input_size: Optional[Tuple[int, ...]] = None,
+    ) -> Generator[MaskData, None, MaskData]:
+        # Crop the image and calculate embeddings, unless they are given
         x0, y0, x1, y1 = crop_box
         cropped_im = image[y0:y1, x0:x1, :]
         cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        if features is None:
+            self.predictor.set_image(cropped_im)
+            features = self.predictor.get_image_embedding()
+            input_size = self.predictor.input_size
+        else:
+            self.predictor.set_features(features, input_size, cropped_im_size)
 
         # Get points for this crop
         points_scale = np.array(cropped_im_size)[None, ::-1]
         points_for_image = self.point_grids[crop_layer_idx] * points_scale
+        point_levels = self._point_levels(crop_layer_idx)
+        covered = np.zeros(cropped_im_size, dtype=bool)
 
-        # Generate masks for this crop in batches
+        # Generate masks for this crop in batches, coarse points first
         data = MaskData()
-        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
-            data.cat(batch_data)
-            del batch_data
+        for level in range(self.adaptive_sampling_levels + 1):
+            level_points = points_for_image[point_levels == level]
+            if level > 0:
+                # Skip points inside masks found at coarser levels
+                idxs = np.minimum(level_points.astype(int), points_scale - 1)
+                level_points = level_points[~covered[idxs[:, 1], idxs[:, 0]]]
+            is_last_level = level == self.adaptive_sampling_levels
+            for (points,) in batch_iterator(self.points_per_batch, level_points):
+                # Another stream may have used the predictor while this one was suspended
+                if self.predictor.features is not features:
+                    self.predictor.set_features(features, input_size, cropped_im_size)
+                batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
+                data.cat(batch_data)
+                if not is_last_level:
+                    self._mark_covered(covered, batch_data, crop_box)
+
+                # Hand out the batch in the original image frame before the crop is done
+                mask_key = "crops" if self._keeps_crops else "rles"
+                batch_data = MaskData(
+                    boxes=uncrop_boxes_xyxy(batch_data["boxes"], crop_box),
+                    points=uncrop_points(batch_data["points"], crop_box),
+                    iou_preds=batch_data["iou_preds"],
+                    stability_score=batch_data["stability_score"],
+                    crop_boxes=torch.tensor([crop_box for _ in range(len(batch_data["boxes"]))]),
+                    **{mask_key: batch_data[mask_key]},
+                )
+                batch_data.to_numpy()
+                yield batch_data
+                del batch_data
         self.predictor.reset_image()
 
         # Remove duplicates within this crop.
@@ -259,10 +605,22 @@ class SamAutomaticMaskGenerator:
         # Return to the original image frame
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["points"] = uncrop_points(data["points"], crop_box)
-        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
+        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["boxes"]))])
 
         return data
 
+    def _mark_covered(self, covered: np.ndarray, data: MaskData, crop_box: List[int]) -> None:
+        # Marks the pixels of a batch's masks in the crop frame
+        x0, y0, x1, y1 = crop_box
+        if self._keeps_crops:
+            for crop, (bx0, by0, _, _) in zip(data["crops"], data["boxes"].tolist()):
+                covered[by0 : by0 + crop.shape[0], bx0 : bx0 + crop.shape[1]] |= crop
+        else:
+            rles = data["rles"]
+            for i, (bx0, by0, bx1, by1) in enumerate(data["boxes"].tolist()):
+                box = [x0 + bx0, y0 + by0, x0 + bx1 + 1, y0 + by1 + 1]
+                covered[by0 : by1 + 1, bx0 : bx1 + 1] |= rles.to_mask(i, box)
+
     def _process_batch(
         self,
         points: np.ndarray,
@@ -276,12 +634,15 @@ class SamAutomaticMaskGenerator:
         transformed_points = self.predictor.transform.apply_coords(points, im_size)
         in_points = torch.as_tensor(transformed_points, device=self.predictor.device)
         in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
-        masks, iou_preds, _ = self.predictor.predict_torch(
-            in_points[:, None, :],
-            in_labels[:, None],
-            multimask_output=True,
-            return_logits=True,
-        )
+        if self.filter_at_low_res:
+            masks, iou_preds = self._predict_low_res(in_points[:, None, :], in_labels[:, None])
+        else:
+            masks, iou_preds, _ = self.predictor.predict_torch(
+                in_points[:, None, :],
+                in_labels[:, None],
+                multimask_output=True,
+                return_logits=True,
+            )
 
         # Serialize predictions and store in MaskData
         data = MaskData(
@@ -297,13 +658,28 @@ class SamAutomaticMaskGenerator:
             data.filter(keep_mask)
 
         # Calculate stability score
+        stability_masks = data["masks"]
+        if self.filter_at_low_res:
+            # Only the part of the low res logits that covers the image, not the padding
+            input_h, input_w = self.predictor.input_size
+            scale = stability_masks.shape[-1] / self.predictor.model.image_encoder.img_size
+            stability_masks = stability_masks[
+                ..., : math.ceil(input_h * scale), : math.ceil(input_w * scale)
+            ]
         data["stability_score"] = calculate_stability_score(
-            data["masks"], self.predictor.model.mask_threshold, self.stability_score_offset
+            stability_masks, self.predictor.model.mask_threshold, self.stability_score_offset
         )
+        del stability_masks
         if self.stability_score_thresh > 0.0:
             keep_mask = data["stability_score"] >= self.stability_score_thresh
             data.filter(keep_mask)
 
+        # Upscale the masks that are left to the image size
+        if self.filter_at_low_res:
+            data["masks"] = self.predictor.model.postprocess_masks(
+                data["masks"][:, None], self.predictor.input_size, self.predictor.original_size
+            )[:, 0]
+
         # Threshold masks and calculate boxes
         data["masks"] = data["masks"] > self.predictor.model.mask_threshold
         data["boxes"] = batched_mask_to_box(data["masks"])
@@ -313,47 +689,114 @@ class SamAutomaticMaskGenerator:
         if not torch.all(keep_mask):
             data.filter(keep_mask)
 
+        if self._keeps_crops:
+            # Keep only the part of each mask inside its box, which is the
+            # same in the crop and the original image frame
+            boxes = data["boxes"].cpu().tolist()
+            data["crops"] = [
+                mask[y0 : y1 + 1, x0 : x1 + 1].cpu().numpy().copy()
+                for mask, (x0, y0, x1, y1) in zip(data["masks"], boxes)
+            ]
+            del data["masks"]
+            return data
+
         # Compress to RLE
         data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
-        data["rles"] = mask_to_rle_pytorch(data["masks"])
+        data["rles"] = RleBuffer.from_masks(data["masks"])
         del data["masks"]
 
         return data
 
+    @torch.no_grad()
+    def _predict_low_res(
+        self, point_coords: torch.Tensor, point_labels: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Like predictor.predict_torch, but without upscaling the masks
+        model = self.predictor.model
+        sparse_embeddings, dense_embeddings = model.prompt_encoder(
+            points=(point_coords, point_labels),
+            boxes=None,
+            masks=None,
+        )
+        low_res_masks, iou_predictions = model.mask_decoder(
+            image_embeddings=self.predictor.features,
+            image_pe=model.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=True,
+        )
+        return low_res_masks, iou_predictions
+
     @staticmethod
     def postprocess_small_regions(
-        mask_data: MaskData, min_area: int, nms_thresh: float
+        mask_data: MaskData,
+        min_area: int,
+        nms_thresh: float,
+        orig_size: Optional[Tuple[int, ...]] = None,
+        num_workers: Optional[int] = None,
     ) -> MaskData:
         """
         Removes small disconnected regions and holes in masks, then reruns
-        box NMS to remove any new duplicates.
+        box NMS to remove any new duplicates. If masks are stored as crops
+        of their boxes, orig_size must give the image size in (H, W) format.
+
+        Each mask is only cleaned up inside its box, padded so that the
+        result is the same as over the whole image. Masks are spread over
+        a pool of num_workers threads, since open-cv releases the GIL.
 
         Edits mask_data in place.
 
         Requires open-cv as a dependency.
         """
-        if len(mask_data["rles"]) == 0:
+        keeps_crops = "crops" in mask_data
+        masks = mask_data["crops" if keeps_crops else "rles"]
+        if len(masks) == 0:
             return mask_data
+        if keeps_crops:
+            assert orig_size is not None, "orig_size is needed to postprocess mask crops."
+        else:
+            orig_size = masks.size
+        h, w = orig_size
+        boxes = torch.as_tensor(mask_data["boxes"]).clone()
+
+        # Background touching the padding reaches at least pad * pad pixels
+        # outside the box, so it is never a small hole. On images too narrow
+        # for that, work over the whole image instead.
+        pad = math.ceil(math.sqrt(min_area))
+        if pad >= min(h, w):
+            pad = max(h, w)
+
+        def clean_mask(i: int) -> Tuple[np.ndarray, List[int], bool]:
+            x0, y0, x1, y1 = boxes[i].tolist()
+            rx0, ry0 = max(x0 - pad, 0), max(y0 - pad, 0)
+            rx1, ry1 = min(x1 + pad + 1, w), min(y1 + pad + 1, h)
+            region_box = [rx0, ry0, rx1, ry1]
+            if keeps_crops:
+                region = np.zeros((ry1 - ry0, rx1 - rx0), dtype=bool)
+                crop = masks[i]
+                y, x = y0 - ry0, x0 - rx0
+                region[y : y + crop.shape[0], x : x + crop.shape[1]] = crop
+            else:
+                region = masks.to_mask(i, region_box)
+            if not region.any():
+                return region, region_box, False
+            region, changed_holes = remove_small_regions(region, min_area, mode="holes")
+            region, changed_islands = remove_small_regions(region, min_area, mode="islands")
+            return region, region_box, changed_holes or changed_islands
 
         # Filter small disconnected regions and holes
-        new_masks = []
-        scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
-
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
-            # Give score=0 to changed masks and score=1 to unchanged masks
-            # so NMS will prefer ones that didn't need postprocessing
-            scores.append(float(unchanged))
-
-        # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
-        boxes = batched_mask_to_box(masks)
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            results = list(pool.map(clean_mask, range(len(masks))))
+
+        # Give score=0 to changed masks and score=1 to unchanged masks
+        # so NMS will prefer ones that didn't need postprocessing
+        scores = [float(not changed) for _, _, changed in results]
+        for i_mask, (region, region_box, changed) in enumerate(results):
+            if changed:
+                box = batched_mask_to_box(torch.from_numpy(region)[None])[0]
+                boxes[i_mask] = box + torch.as_tensor(region_box[:2] * 2)
+
+        # Remove any new duplicates
         keep_by_nms = batched_nms(
             boxes.float(),
             torch.as_tensor(scores),
@@ -361,12 +804,22 @@ class SamAutomaticMaskGenerator:
             iou_threshold=nms_thresh,
         )
 
-        # Only recalculate RLEs for masks that have changed
-        for i_mask in keep_by_nms:
-            if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
-                mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
+        # Only recalculate RLEs or crops for masks that have changed
+        changed = [i_mask for i_mask in keep_by_nms.tolist() if scores[i_mask] == 0.0]
+        new_rles = []
+        for i_mask in changed:
+            region, (rx0, ry0, rx1, ry1), _ = results[i_mask]
+            if keeps_crops:
+                x0, y0, x1, y1 = boxes[i_mask].tolist()
+                crop = region[y0 - ry0 : y1 - ry0 + 1, x0 - rx0 : x1 - rx0 + 1]
+                mask_data["crops"][i_mask] = crop.copy()
+            else:
+                mask = torch.zeros((1, h, w), dtype=torch.bool)
+                mask[0, ry0:ry1, rx0:rx1] = torch.from_numpy(region)
+                new_rles.append(RleBuffer.from_masks(mask))
+            mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
+        if new_rles:
+            mask_data["rles"] = masks.replace(np.array(changed), RleBuffer.cat(new_rles))
         mask_data.filter(keep_by_nms)
 
         return mask_data
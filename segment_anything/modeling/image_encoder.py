@@ -166,17 +166,17 @@ class Block(nn.Module):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         shortcut = x
         x = self.norm1(x)
-        # Window partition
+        # Pad to a multiple of the window size, attention partitions the windows itself
+        H, W = x.shape[1], x.shape[2]
         if self.window_size > 0:
-            H, W = x.shape[1], x.shape[2]
-            x, pad_hw = window_partition(x, self.window_size)
+            pad_h = (self.window_size - H % self.window_size) % self.window_size
+            pad_w = (self.window_size - W % self.window_size) % self.window_size
+            if pad_h > 0 or pad_w > 0:
+                x = F.pad(x, (0, 0, 0, pad_w, 0, pad_h))
 
-        x = self.attn(x)
-        # Reverse window partition
-        if self.window_size > 0:
-            x = window_unpartition(x, self.window_size, pad_hw, (H, W))
+        x = self.attn(x, self.window_size)
 
-        x = shortcut + x
+        x = shortcut + x[:, :H, :W]
         x = x + self.mlp(self.norm2(x))
 
         return x
@@ -220,21 +220,50 @@ class Attention(nn.Module):
             # initialize relative positional embeddings
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
+            # index of every query and key pair into the tables above at input_size
+            self.input_size = tuple(input_size)
+            self.register_buffer(
+                "rel_pos_index_h", get_rel_pos_index(input_size[0], input_size[0]), persistent=False
+            )
+            self.register_buffer(
+                "rel_pos_index_w", get_rel_pos_index(input_size[1], input_size[1]), persistent=False
+            )
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        B, H, W, _ = x.shape
-        # qkv with shape (3, B, nHead, H * W, C)
-        qkv = self.qkv(x).reshape(B, H * W, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
-        # q, k, v with shape (B * nHead, H * W, C)
-        q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
+    def forward(self, x: torch.Tensor, window_size: int = 0) -> torch.Tensor:
+        """
+        Args:
+            x (tensor): input tokens with [B, Hp, Wp, C].
+            window_size (int): attend within non-overlapping windows of this size, which
+                must divide Hp and Wp, or globally if it equals 0.
 
-        attn = (q * self.scale) @ k.transpose(-2, -1)
+        Returns:
+            x (tensor): output tokens with [B, Hp, Wp, C].
+        """
+        B, Hp, Wp, _ = x.shape
+        H, W = (window_size, window_size) if window_size > 0 else (Hp, Wp)
+        # Windows are partitioned and merged back by the copies that split and merge the
+        # heads, so they cost no extra copy of the activations.
+        # qkv with shape (3, B, Hp // H, Wp // W, nHead, H, W, C)
+        qkv = self.qkv(x).view(B, Hp // H, H, Wp // W, W, 3, self.num_heads, -1)
+        qkv = qkv.permute(5, 0, 1, 3, 6, 2, 4, 7)
+        # q, k, v with shape (B * num_windows * nHead, H * W, C)
+        q, k, v = qkv.reshape(3, -1, H * W, qkv.shape[-1]).unbind(0)
 
         if self.use_rel_pos:
-            attn = add_decomposed_rel_pos(attn, q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
-
-        attn = attn.softmax(dim=-1)
-        x = (attn @ v).view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+            if (H, W) == self.input_size:
+                rel_pos_index = (self.rel_pos_index_h, self.rel_pos_index_w)
+            else:
+                rel_pos_index = (None, None)
+            rel_h, rel_w = get_decomposed_rel_pos(
+                q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W), *rel_pos_index
+            )
+            x = rel_pos_attention(q, k, v, rel_h, rel_w, self.scale)
+        elif hasattr(F, "scaled_dot_product_attention"):
+            x = F.scaled_dot_product_attention(q, k, v)
+        else:
+            x = ((q * self.scale) @ k.transpose(-2, -1)).softmax(dim=-1) @ v
+        x = x.view(B, Hp // H, Wp // W, self.num_heads, H, W, -1)
+        x = x.permute(0, 1, 4, 2, 5, 3, 6).reshape(B, Hp, Wp, -1)
         x = self.proj(x)
 
         return x
@@ -289,7 +318,27 @@ def window_unpartition(
     return x
 
 
-def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor:
+def get_rel_pos_index(q_size: int, k_size: int) -> torch.Tensor:
+    """
+    Get the index into relative positional embeddings, resized to 2 * max(q_size, k_size) - 1,
+        of the relative position of every query and key.
+    Args:
+        q_size (int): size of query q.
+        k_size (int): size of key k.
+
+    Returns:
+        Index with shape (q_size, k_size).
+    """
+    # Scale the coords with short length if shapes for q and k are different.
+    q_coords = torch.arange(q_size)[:, None] * max(k_size / q_size, 1.0)
+    k_coords = torch.arange(k_size)[None, :] * max(q_size / k_size, 1.0)
+    relative_coords = (q_coords - k_coords) + (k_size - 1) * max(q_size / k_size, 1.0)
+    return relative_coords.long()
+
+
+def get_rel_pos(
+    q_size: int, k_size: int, rel_pos: torch.Tensor, rel_pos_index: Optional[torch.Tensor] = None
+) -> torch.Tensor:
     """
     Get relative positional embeddings according to the relative positions of
         query and key sizes.
@@ -297,6 +346,7 @@ def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor
         q_size (int): size of query q.
         k_size (int): size of key k.
         rel_pos (Tensor): relative position embeddings (L, C).
+        rel_pos_index (Tensor or None): precomputed get_rel_pos_index(q_size, k_size).
 
     Returns:
         Extracted positional embeddings according to relative positions.
@@ -314,12 +364,45 @@ def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor
     else:
         rel_pos_resized = rel_pos
 
-    # Scale the coords with short length if shapes for q and k are different.
-    q_coords = torch.arange(q_size)[:, None] * max(k_size / q_size, 1.0)
-    k_coords = torch.arange(k_size)[None, :] * max(q_size / k_size, 1.0)
-    relative_coords = (q_coords - k_coords) + (k_size - 1) * max(q_size / k_size, 1.0)
+    if rel_pos_index is None:
+        rel_pos_index = get_rel_pos_index(q_size, k_size)
+    return rel_pos_resized[rel_pos_index]
+
+
+def get_decomposed_rel_pos(
+    q: torch.Tensor,
+    rel_pos_h: torch.Tensor,
+    rel_pos_w: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+    rel_pos_index_h: Optional[torch.Tensor] = None,
+    rel_pos_index_w: Optional[torch.Tensor] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Calculate the height and width terms of decomposed Relative Positional Embeddings.
+    Args:
+        q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
+        rel_pos_h (Tensor): relative position embeddings (Lh, C) for height axis.
+        rel_pos_w (Tensor): relative position embeddings (Lw, C) for width axis.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+        rel_pos_index_h (Tensor or None): precomputed get_rel_pos_index(q_h, k_h).
+        rel_pos_index_w (Tensor or None): precomputed get_rel_pos_index(q_w, k_w).
+
+    Returns:
+        rel_h (Tensor): height terms with shape (B, q_h, q_w, k_h).
+        rel_w (Tensor): width terms with shape (B, q_h, q_w, k_w).
+    """
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+    Rh = get_rel_pos(q_h, k_h, rel_pos_h, rel_pos_index_h)
+    Rw = get_rel_pos(q_w, k_w, rel_pos_w, rel_pos_index_w)
 
-    return rel_pos_resized[relative_coords.long()]
+    B, _, dim = q.shape
+    r_q = q.reshape(B, q_h, q_w, dim)
+    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
+    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+    return rel_h, rel_w
 
 
 def add_decomposed_rel_pos(
@@ -346,21 +429,68 @@ def add_decomposed_rel_pos(
     """
     q_h, q_w = q_size
     k_h, k_w = k_size
-    Rh = get_rel_pos(q_h, k_h, rel_pos_h)
-    Rw = get_rel_pos(q_w, k_w, rel_pos_w)
-
-    B, _, dim = q.shape
-    r_q = q.reshape(B, q_h, q_w, dim)
-    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
-    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+    rel_h, rel_w = get_decomposed_rel_pos(q, rel_pos_h, rel_pos_w, q_size, k_size)
 
-    attn = (
-        attn.view(B, q_h, q_w, k_h, k_w) + rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]
-    ).view(B, q_h * q_w, k_h * k_w)
+    B = q.shape[0]
+    # One new map for the sum instead of one per term
+    attn = attn.view(B, q_h, q_w, k_h, k_w).add(rel_h[:, :, :, :, None])
+    attn = attn.add_(rel_w[:, :, :, None, :]).view(B, q_h * q_w, k_h * k_w)
 
     return attn
 
 
+def rel_pos_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    rel_h: torch.Tensor,
+    rel_w: torch.Tensor,
+    scale: float,
+    max_chunk_numel: int = 2**24,
+) -> torch.Tensor:
+    """
+    Attention with decomposed relative positional embeddings added to the attention map
+    as a bias, without materializing the whole map. Query rows are processed in chunks
+    whose bias has at most max_chunk_numel elements, each through the fused
+    scaled_dot_product_attention if this version of PyTorch has it.
+    Args:
+        q (Tensor): query q with shape (B, q_h * q_w, C).
+        k (Tensor): key k with shape (B, k_h * k_w, C).
+        v (Tensor): value v with shape (B, k_h * k_w, C).
+        rel_h (Tensor): height terms with shape (B, q_h, q_w, k_h), from get_decomposed_rel_pos.
+        rel_w (Tensor): width terms with shape (B, q_h, q_w, k_w), from get_decomposed_rel_pos.
+        scale (float): scale of the attention logits, must be C**-0.5 to use the fused kernel.
+        max_chunk_numel (int): maximum number of elements of the bias of one chunk.
+
+    Returns:
+        x (Tensor): attention output with shape (B, q_h * q_w, C).
+    """
+    B, q_h, q_w, k_h = rel_h.shape
+    k_w = rel_w.shape[-1]
+    rows_per_chunk = max(1, max_chunk_numel // (B * q_w * k_h * k_w))
+    use_sdpa = hasattr(F, "scaled_dot_product_attention") and scale == q.shape[-1] ** -0.5
+
+    # Without autograd the two terms are summed straight into the bias, which saves a copy
+    inplace = not (torch.is_grad_enabled() and (rel_h.requires_grad or rel_w.requires_grad))
+
+    out = []
+    for row in range(0, q_h, rows_per_chunk):
+        rows = slice(row, min(row + rows_per_chunk, q_h))
+        if inplace:
+            bias = rel_h.new_empty((B, rows.stop - rows.start, q_w, k_h, k_w))
+            torch.add(rel_h[:, rows, :, :, None], rel_w[:, rows, :, None, :], out=bias)
+        else:
+            bias = rel_h[:, rows, :, :, None] + rel_w[:, rows, :, None, :]
+        bias = bias.reshape(B, -1, k_h * k_w)
+        q_chunk = q[:, rows.start * q_w : rows.stop * q_w]
+        if use_sdpa:
+            out.append(F.scaled_dot_product_attention(q_chunk, k, v, attn_mask=bias))
+        else:
+            attn = torch.baddbmm(bias, q_chunk * scale, k.transpose(-2, -1))
+            out.append(attn.softmax(dim=-1) @ v)
+    return torch.cat(out, dim=1) if len(out) > 1 else out[0]
+
+
 class PatchEmbed(nn.Module):
     """
     Image to Patch Embedding.
@@ -89,6 +89,32 @@ class SamPredictor:
         self.features = self.model.image_encoder(input_image)
         self.is_image_set = True
 
+    def set_features(
+        self,
+        features: torch.Tensor,
+        input_size: Tuple[int, ...],
+        original_size: Tuple[int, ...],
+    ) -> None:
+        """
+        Sets precomputed image embeddings, allowing masks to be predicted
+        with the 'predict' method without running the image encoder again.
+        The embeddings must come from 'get_image_embedding' on a predictor
+        using the same model.
+
+        Arguments:
+          features (torch.Tensor): The image embeddings, with shape 1xCxHxW.
+          input_size (tuple(int, int)): The size of the transformed image
+            input to the model, in (H, W) format.
+          original_size (tuple(int, int)): The size of the image before
+            transformation, in (H, W) format.
+        """
+        self.reset_image()
+
+        self.original_size = tuple(original_size)
+        self.input_size = tuple(input_size)
+        self.features = features.to(self.device)
+        self.is_image_set = True
+
     def predict(
         self,
         point_coords: Optional[np.ndarray] = None,
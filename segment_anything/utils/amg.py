@@ -10,45 +10,152 @@ import torch
 import math
 from copy import deepcopy
 from itertools import product
-from typing import Any, Dict, Generator, ItemsView, List, Tuple
+from typing import Any, Dict, Generator, ItemsView, List, Optional, Tuple, Union
+
+
+class RleBuffer:
+    """
+    Uncompressed RLEs of masks of the same size, stored column-wise: the
+    run lengths of all masks back to back in one flat array, with B+1
+    offsets so the counts of mask i are counts[offsets[i] : offsets[i + 1]].
+    Selecting, joining and measuring masks are array operations. Indexing
+    with an int gives the RLE in the format expected by pycoco tools.
+    """
+
+    def __init__(self, counts: np.ndarray, offsets: np.ndarray, size: Tuple[int, int]) -> None:
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.size = (int(size[0]), int(size[1]))
+
+    @classmethod
+    def from_masks(cls, masks: torch.Tensor) -> "RleBuffer":
+        """Encodes a batch of masks in BxHxW format."""
+        counts, offsets = batched_mask_to_rle_counts(masks)
+        return cls(counts, offsets, masks.shape[1:])
+
+    @classmethod
+    def from_rles(cls, rles: List[Dict[str, Any]], size: Tuple[int, int]) -> "RleBuffer":
+        lengths = [len(rle["counts"]) for rle in rles]
+        counts = np.fromiter(
+            (c for rle in rles for c in rle["counts"]), dtype=np.int64, count=sum(lengths)
+        )
+        return cls(counts, np.concatenate([[0], np.cumsum(lengths)]), size)
+
+    @classmethod
+    def cat(cls, buffers: List["RleBuffer"]) -> "RleBuffer":
+        size = buffers[0].size
+        assert all(b.size == size for b in buffers), "RLEs must all have the same size."
+        starts = np.cumsum([0] + [len(b.counts) for b in buffers[:-1]])
+        offsets = [buffers[0].offsets[:1]] + [b.offsets[1:] + s for b, s in zip(buffers, starts)]
+        return cls(np.concatenate([b.counts for b in buffers]), np.concatenate(offsets), size)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        counts = self.counts[self.offsets[i] : self.offsets[i + 1]]
+        return {"size": list(self.size), "counts": counts.tolist()}
+
+    def __iter__(self) -> Generator[Dict[str, Any], None, None]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __setitem__(self, i: int, rle: Dict[str, Any]) -> None:
+        replaced = self.replace(np.array([i]), RleBuffer.from_rles([rle], self.size))
+        self.counts, self.offsets = replaced.counts, replaced.offsets
+
+    def to_mask(self, i: int, crop_box: Optional[List[int]] = None) -> np.ndarray:
+        """
+        Decodes mask i, or only its part inside crop_box in XYXY format.
+        Only the runs over the columns of crop_box are expanded.
+        """
+        h, w = self.size
+        x0, y0, x1, y1 = crop_box if crop_box is not None else (0, 0, w, h)
+        counts = self.counts[self.offsets[i] : self.offsets[i + 1]]
+        # In fortran order the columns x0 to x1 are one span of the flat mask
+        ends = np.cumsum(counts)
+        lo, hi = x0 * h, x1 * h
+        counts = np.clip(ends, lo, hi) - np.clip(ends - counts, lo, hi)
+        flat = np.repeat(np.arange(len(counts)) % 2 == 1, counts)
+        return np.ascontiguousarray(flat.reshape(x1 - x0, h).T[y0:y1])
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def filter(self, keep: np.ndarray) -> "RleBuffer":
+        """Selects masks by a boolean mask or an array of indices."""
+        keep = np.asarray(keep)
+        idxs = np.flatnonzero(keep) if keep.dtype == bool else keep.astype(np.int64)
+        return self._gather(self.counts, self.offsets[idxs], self.lengths()[idxs])
+
+    def replace(self, idxs: np.ndarray, other: "RleBuffer") -> "RleBuffer":
+        """Returns a copy with the masks at idxs replaced by those of other."""
+        assert other.size == self.size, "RLEs must all have the same size."
+        starts, lengths = self.offsets[:-1].copy(), self.lengths()
+        starts[idxs] = other.offsets[:-1] + len(self.counts)
+        lengths[idxs] = other.lengths()
+        return self._gather(np.concatenate([self.counts, other.counts]), starts, lengths)
+
+    def areas(self) -> np.ndarray:
+        """The area of each mask, the sum of its every second run."""
+        run_idxs = np.arange(len(self.counts)) - np.repeat(self.offsets[:-1], self.lengths())
+        ones = np.concatenate([[0], np.cumsum(self.counts * (run_idxs % 2))])
+        return ones[self.offsets[1:]] - ones[self.offsets[:-1]]
+
+    def _gather(self, counts: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> "RleBuffer":
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        src = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+        return RleBuffer(counts[src], offsets, self.size)
 
 
 class MaskData:
     """
     A structure for storing masks and their related data in batched format.
-    Implements basic filtering and concatenation.
+    Implements basic filtering and concatenation. Concatenated batches are
+    kept as chunks and joined once, when the data is next read.
     """
 
     def __init__(self, **kwargs) -> None:
         for v in kwargs.values():
             assert isinstance(
-                v, (list, np.ndarray, torch.Tensor)
-            ), "MaskData only supports list, numpy arrays, and torch tensors."
+                v, (list, np.ndarray, torch.Tensor, RleBuffer)
+            ), "MaskData only supports list, numpy arrays, torch tensors and RleBuffer."
         self._stats = dict(**kwargs)
+        self._chunks: Dict[str, List[Any]] = {}
 
     def __setitem__(self, key: str, item: Any) -> None:
         assert isinstance(
-            item, (list, np.ndarray, torch.Tensor)
-        ), "MaskData only supports list, numpy arrays, and torch tensors."
+            item, (list, np.ndarray, torch.Tensor, RleBuffer)
+        ), "MaskData only supports list, numpy arrays, torch tensors and RleBuffer."
+        self._chunks.pop(key, None)
         self._stats[key] = item
 
     def __delitem__(self, key: str) -> None:
+        self._chunks.pop(key, None)
         del self._stats[key]
 
     def __getitem__(self, key: str) -> Any:
+        self._join(key)
         return self._stats[key]
 
+    def __contains__(self, key: str) -> bool:
+        return key in self._stats
+
     def items(self) -> ItemsView[str, Any]:
+        for k in list(self._chunks):
+            self._join(k)
         return self._stats.items()
 
     def filter(self, keep: torch.Tensor) -> None:
-        for k, v in self._stats.items():
+        for k, v in self.items():
             if v is None:
                 self._stats[k] = None
             elif isinstance(v, torch.Tensor):
                 self._stats[k] = v[torch.as_tensor(keep, device=v.device)]
             elif isinstance(v, np.ndarray):
                 self._stats[k] = v[keep.detach().cpu().numpy()]
+            elif isinstance(v, RleBuffer):
+                self._stats[k] = v.filter(keep.detach().cpu().numpy())
             elif isinstance(v, list) and keep.dtype == torch.bool:
                 self._stats[k] = [a for i, a in enumerate(v) if keep[i]]
             elif isinstance(v, list):
@@ -59,21 +166,31 @@ class MaskData:
     def cat(self, new_stats: "MaskData") -> None:
         for k, v in new_stats.items():
             if k not in self._stats or self._stats[k] is None:
-                self._stats[k] = deepcopy(v)
-            elif isinstance(v, torch.Tensor):
-                self._stats[k] = torch.cat([self._stats[k], v], dim=0)
-            elif isinstance(v, np.ndarray):
-                self._stats[k] = np.concatenate([self._stats[k], v], axis=0)
-            elif isinstance(v, list):
-                self._stats[k] = self._stats[k] + deepcopy(v)
+                self._stats[k] = v
+            elif isinstance(v, (torch.Tensor, np.ndarray, list, RleBuffer)):
+                self._chunks.setdefault(k, []).append(v)
             else:
                 raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
 
     def to_numpy(self) -> None:
-        for k, v in self._stats.items():
+        for k, v in self.items():
             if isinstance(v, torch.Tensor):
                 self._stats[k] = v.detach().cpu().numpy()
 
+    def _join(self, key: str) -> None:
+        chunks = self._chunks.pop(key, None)
+        if chunks is None:
+            return
+        v = self._stats[key]
+        if isinstance(v, torch.Tensor):
+            self._stats[key] = torch.cat([v] + chunks, dim=0)
+        elif isinstance(v, np.ndarray):
+            self._stats[key] = np.concatenate([v] + chunks, axis=0)
+        elif isinstance(v, RleBuffer):
+            self._stats[key] = RleBuffer.cat([v] + chunks)
+        else:
+            self._stats[key] = v + [a for chunk in chunks for a in chunk]
+
 
 def is_box_near_crop_edge(
     boxes: torch.Tensor, crop_box: List[int], orig_box: List[int], atol: float = 20.0
@@ -104,49 +221,114 @@ def batch_iterator(batch_size: int, *args) -> Generator[List[Any], None, None]:
         yield [arg[b * batch_size : (b + 1) * batch_size] for arg in args]
 
 
+def batched_mask_to_rle_counts(tensor: torch.Tensor) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encodes a batch of masks to uncompressed RLE run lengths in one pass.
+    Returns a flat array holding the counts of every mask back to back and
+    an array of B+1 offsets, so the counts of mask i are
+    counts[offsets[i] : offsets[i + 1]]. Counts are in the format expected
+    by pycoco tools, starting with a run of zeros that may be empty.
+    """
+    # A run starts where the value differs from the previous pixel in fortran
+    # order, which is the pixel above or, in the first row, the last pixel of
+    # the previous column. Pixel 0 starts a run if it is a one, the leading
+    # run of zeros is then empty. Run starts are found in the original layout
+    # to skip transposing the whole batch and only they are put in order.
+    b, h, w = tensor.shape
+    change = torch.empty((b, h, w), dtype=torch.bool, device=tensor.device)
+    torch.bitwise_xor(tensor[:, 1:, :], tensor[:, :-1, :], out=change[:, 1:, :])
+    torch.bitwise_xor(tensor[:, 0, 1:], tensor[:, -1, :-1], out=change[:, 0, 1:])
+    change[:, 0, 0] = tensor[:, 0, 0]
+    if change.device.type == "cpu":
+        # Several times faster than torch.nonzero on CPU
+        flat_idxs = torch.from_numpy(np.flatnonzero(change.numpy()))
+    else:
+        flat_idxs = change.flatten().nonzero().squeeze(1)
+    del change
+    mask_idxs = flat_idxs // (h * w)
+    run_starts = (flat_idxs % w) * h + (flat_idxs // w) % h
+    keys = torch.sort(mask_idxs * (h * w) + run_starts).values
+    mask_idxs, run_starts = keys // (h * w), keys % (h * w)
+    del flat_idxs, keys
+
+    # Every mask has one more run than run starts, the last one ends at h * w
+    n_starts = torch.bincount(mask_idxs, minlength=b)
+    offsets = torch.zeros(b + 1, dtype=torch.int64, device=tensor.device)
+    offsets[1:] = torch.cumsum(n_starts + 1, dim=0)
+
+    # Run starts come sorted by mask. Each one closes the run before it,
+    # which began at the previous run start of the same mask or at 0.
+    is_first = torch.ones_like(mask_idxs, dtype=torch.bool)
+    is_first[1:] = mask_idxs[1:] != mask_idxs[:-1]
+    is_last = torch.ones_like(mask_idxs, dtype=torch.bool)
+    is_last[:-1] = is_first[1:]
+    prev_starts = torch.zeros_like(run_starts)
+    prev_starts[1:] = run_starts[:-1]
+    prev_starts[is_first] = 0
+
+    # The ith run start of mask m closes run i, at offsets[m] + i. As mask
+    # m is preceded by m more runs than run starts, that is its index plus m.
+    counts = torch.empty(int(offsets[-1]), dtype=torch.int64, device=tensor.device)
+    run_idxs = torch.arange(len(run_starts), device=tensor.device) + mask_idxs
+    counts[run_idxs] = run_starts - prev_starts
+    last_starts = torch.zeros(b, dtype=torch.int64, device=tensor.device)
+    last_starts[mask_idxs[is_last]] = run_starts[is_last]
+    counts[offsets[1:] - 1] = h * w - last_starts
+
+    return counts.cpu().numpy(), offsets.cpu().numpy()
+
+
 def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     """
     Encodes masks to an uncompressed RLE, in the format expected by
     pycoco tools.
     """
-    # Put in fortran order and flatten h,w
     b, h, w = tensor.shape
-    tensor = tensor.permute(0, 2, 1).flatten(1)
-
-    # Compute change indices
-    diff = tensor[:, 1:] ^ tensor[:, :-1]
-    change_indices = diff.nonzero()
-
-    # Encode run length
-    out = []
-    for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
-        out.append({"size": [h, w], "counts": counts})
-    return out
+    counts, offsets = batched_mask_to_rle_counts(tensor)
+    counts, offsets = counts.tolist(), offsets.tolist()
+    return [{"size": [h, w], "counts": counts[offsets[i] : offsets[i + 1]]} for i in range(b)]
 
 
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
     h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
-    mask = mask.reshape(w, h)
-    return mask.transpose()  # Put in C order
+    mask = np.empty((h, w), dtype=bool)
+    _decode_rle_into(rle["counts"], mask)
+    return mask
+
+
+def batched_rle_to_mask(
+    rles: Union[List[Dict[str, Any]], RleBuffer], out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Computes binary masks from uncompressed RLEs of the same size, written
+    straight into one C-contiguous array of shape NxHxW. If given, 'out' is
+    filled instead of allocating a new array.
+    """
+    if len(rles) == 0:
+        return np.empty((0, 0, 0), dtype=bool) if out is None else out
+    h, w = rles.size if isinstance(rles, RleBuffer) else rles[0]["size"]
+    if out is None:
+        out = np.empty((len(rles), h, w), dtype=bool)
+    assert out.shape == (len(rles), h, w), f"out must have shape {(len(rles), h, w)}."
+    if isinstance(rles, RleBuffer):
+        for i, mask in enumerate(out):
+            _decode_rle_into(rles.counts[rles.offsets[i] : rles.offsets[i + 1]], mask)
+        return out
+    for rle, mask in zip(rles, out):
+        assert list(rle["size"]) == [h, w], "All RLEs must have the same size."
+        _decode_rle_into(rle["counts"], mask)
+    return out
+
+
+def _decode_rle_into(counts: List[int], mask: np.ndarray) -> None:
+    # Runs alternate between zeros and ones starting with zeros, so the
+    # whole mask is every run's parity repeated by its length, in fortran order
+    h, w = mask.shape
+    parity = np.arange(len(counts)) % 2 == 1
+    flat = np.repeat(parity, counts)
+    assert flat.size == h * w, "RLE counts do not add up to the mask size."
+    mask[...] = flat.reshape(w, h).T  # Put in C order
 
 
 def area_from_rle(rle: Dict[str, Any]) -> int:
@@ -186,6 +368,21 @@ def build_point_grid(n_per_side: int) -> np.ndarray:
     return points
 
 
+def point_grid_levels(points: np.ndarray, n_levels: int) -> np.ndarray:
+    """
+    Assigns the points of a grid to levels for coarse-to-fine sampling.
+    Level 0 holds every (2**n_levels)th point along both axes, and each
+    next level halves that spacing, so that level n_levels holds all the
+    remaining points.
+    """
+    cols = np.unique(points[:, 0], return_inverse=True)[1]
+    rows = np.unique(points[:, 1], return_inverse=True)[1]
+    levels = np.full(len(points), n_levels)
+    for i in range(1, n_levels + 1):
+        levels[(cols % 2**i == 0) & (rows % 2**i == 0)] = n_levels - i
+    return levels
+
+
 def build_all_layer_point_grids(
     n_per_side: int, n_layers: int, scale_per_layer: int
 ) -> List[np.ndarray]:
@@ -197,6 +394,25 @@ def build_all_layer_point_grids(
     return points_by_layer
 
 
+def crop_edge_density(
+    image: np.ndarray, crop_box: List[int], max_side: int = 256, edge_thresh: float = 8.0
+) -> float:
+    """
+    Measures how much texture a crop of an HWC uint8 image has, as the
+    fraction of pixels where the gray level changes by more than
+    edge_thresh to the next pixel down or right. Measured on every nth
+    pixel, so that the long side of the crop is at most max_side.
+    """
+    x0, y0, x1, y1 = crop_box
+    step = max(1, math.ceil(max(x1 - x0, y1 - y0) / max_side))
+    gray = image[y0:y1:step, x0:x1:step].astype(np.float32).mean(axis=-1)
+    if min(gray.shape) < 2:
+        return 0.0
+    grad_y = np.abs(np.diff(gray, axis=0))[:, :-1]
+    grad_x = np.abs(np.diff(gray, axis=1))[:-1, :]
+    return float(np.mean(np.maximum(grad_x, grad_y) > edge_thresh))
+
+
 def generate_crop_boxes(
     im_size: Tuple[int, ...], n_layers: int, overlap_ratio: float
 ) -> Tuple[List[List[int]], List[int]]:
@@ -150,15 +150,12 @@ function sendStrokeDataToServer(strokeData) {
         type: "POST",
         data: JSON.stringify({ 
             stroke_data: strokeData,
+            delta: true,
+            frame: currentFrame,
         }),
         contentType: "application/json",
         success: function (response) {
-            const image = new Image();
-            image.src = "data:image/jpeg;base64," + response.image;
-            image.onload = function () {
-                $("#preview").attr("src", image.src);
-                $('#zoom-image').attr('src', image.src);
-            };
+            applyFrameResponse(response);
         },
         error: function (error) {
             console.error(error);
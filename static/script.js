@@ -388,4 +388,72 @@ function toggleZoomButton(zoomEnabled) {
     else {
         $("#toggle-zoom").removeClass("selected-view");
     }
-}
\ No newline at end of file
+}
+// The frame shown in #preview. Responses to requests sent with
+// { delta: true, frame: currentFrame } only carry the changed region, which is
+// drawn onto canvases laid over #preview and the zoom image instead of
+// downloading, or encoding again, the whole image.
+let currentFrame = 0;
+let frameQueue = Promise.resolve();
+const frameOverlays = [
+    document.getElementById('frame-overlay'),
+    document.getElementById('zoom-overlay'),
+];
+
+// Keep the overlay on top of #preview as it is zoomed or resized
+new ResizeObserver(function () {
+    const preview = document.getElementById('preview');
+    const overlay = frameOverlays[0];
+    overlay.style.left = preview.offsetLeft + 'px';
+    overlay.style.top = preview.offsetTop + 'px';
+    overlay.style.width = preview.clientWidth + 'px';
+    overlay.style.height = preview.clientHeight + 'px';
+}).observe(document.getElementById('preview'));
+
+function loadImage(src) {
+    return new Promise((resolve, reject) => {
+        const image = new Image();
+        image.onload = () => resolve(image);
+        image.onerror = reject;
+        image.src = src;
+    });
+}
+
+function showFrame(src) {
+    $("#preview").attr("src", src);
+    $('#zoom-image').attr('src', src);
+}
+
+function resetFrame(image, frame) {
+    // Resizing a canvas also clears it
+    for (const overlay of frameOverlays) {
+        overlay.width = image.naturalWidth;
+        overlay.height = image.naturalHeight;
+    }
+    currentFrame = frame;
+}
+
+function applyFrameResponse(response) {
+    // Apply responses in arrival order, images load asynchronously
+    frameQueue = frameQueue.then(async function () {
+        if (response.image !== undefined) {
+            const image = await loadImage("data:image/jpeg;base64," + response.image);
+            resetFrame(image, response.frame);
+            showFrame(image.src);
+        }
+        else if (response.delta !== undefined) {
+            const delta = response.delta;
+            const patch = await loadImage("data:image/png;base64," + delta.image);
+            for (const overlay of frameOverlays) {
+                const ctx = overlay.getContext('2d');
+                ctx.clearRect(delta.x, delta.y, delta.width, delta.height);
+                ctx.drawImage(patch, delta.x, delta.y);
+            }
+            currentFrame = response.frame;
+        }
+        else {
+            currentFrame = response.frame;
+        }
+    }).catch(error => console.error(error));
+    return frameQueue;
+}
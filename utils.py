@@ -1,7 +1,96 @@
+import hashlib
 import os
 
+import numpy as np
+
+
 def mkdir_or_exist(dir_name, mode=0o777):
     if dir_name == '':
         return
     dir_name = os.path.expanduser(dir_name)
-    os.makedirs(dir_name, mode=mode, exist_ok=True)
\ No newline at end of file
+    os.makedirs(dir_name, mode=mode, exist_ok=True)
+
+
+def hash_image(image, *extra):
+    """Content hash of a decoded image, optionally salted with extra keys."""
+    h = hashlib.blake2b(digest_size=20)
+    for key in extra:
+        h.update(str(key).encode())
+    h.update(str(image.shape).encode())
+    h.update(str(image.dtype).encode())
+    h.update(memoryview(np.ascontiguousarray(image)).cast('B'))
+    return h.hexdigest()
+
+
+def mask_bbox(mask):
+    """Tight bounding box (y0, y1, x0, x1) of a boolean mask, or None if it is empty."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask[rows[0]:rows[-1] + 1].any(axis=0))
+    return int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+
+
+def union_bbox(a, b):
+    """Smallest (y0, y1, x0, x1) box containing both boxes, either of which may be None."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+
+
+def intersect_bbox(a, b):
+    """Overlap of two (y0, y1, x0, x1) boxes, or None if they do not overlap or either is None."""
+    if a is None or b is None:
+        return None
+    y0, y1, x0, x1 = max(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), min(a[3], b[3])
+    if y0 >= y1 or x0 >= x1:
+        return None
+    return y0, y1, x0, x1
+
+
+class PackedMask:
+    """Boolean mask stored as a bit-packed crop of its bounding box.
+
+    bbox is (y0, y1, x0, x1) in the full image, or None for an empty mask.
+    """
+
+    def __init__(self, crop, bbox):
+        self.bbox = bbox
+        self.shape = crop.shape
+        self.packed = np.packbits(crop, axis=-1)
+
+    @classmethod
+    def from_mask(cls, mask, bbox=None):
+        if bbox is None:
+            bbox = mask_bbox(mask)
+        if bbox is None:
+            return cls(np.zeros((0, 0), dtype=bool), None)
+        y0, y1, x0, x1 = bbox
+        return cls(mask[y0:y1, x0:x1], bbox)
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    @property
+    def area(self):
+        return int(np.unpackbits(self.packed).sum())
+
+    def crop(self, bbox=None):
+        """Unpacked boolean crop of the bounding box, or of its part inside bbox, which it must overlap."""
+        if bbox is None:
+            return np.unpackbits(self.packed, axis=-1, count=self.shape[1]).view(bool)
+        y0, y1, x0, x1 = intersect_bbox(self.bbox, bbox)
+        rows = self.packed[y0 - self.bbox[0]:y1 - self.bbox[0]]
+        crop = np.unpackbits(rows, axis=-1, count=self.shape[1]).view(bool)
+        return crop[:, x0 - self.bbox[2]:x1 - self.bbox[2]]
+
+    def to_mask(self, size):
+        """Full-size boolean mask of shape size = (H, W)."""
+        mask = np.zeros(size, dtype=bool)
+        if self.bbox is not None:
+            y0, y1, x0, x1 = self.bbox
+            mask[y0:y1, x0:x1] = self.crop()
+        return mask